@@ -0,0 +1,93 @@
+# Copyright 2018-2020 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Import-time benchmark and regression guard for dlutils.
+
+Each statement is timed in a fresh interpreter, so nothing is cached in ``sys.modules`` between runs. The script exits
+with a non-zero status if a statement imports one of the heavy dependencies it must not touch, or if its median time
+exceeds ``--budget``.
+
+Example:
+
+    ::
+
+        python benchmarks/import_time.py --repeat 10 --budget 150
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+HEAVY = ['torch', 'matplotlib', 'sklearn', 'scipy', 'PIL', 'yacs', 'tensorflow']
+
+# Statement to benchmark and the heavy modules it is allowed to import
+CASES = [
+    ('import dlutils', []),
+    ('from dlutils import batch_provider', []),
+    ('from dlutils import async_func, async_map', []),
+    ('from dlutils import cache, SampleCache', []),
+    ('from dlutils import reader, shuffle, timer, epoch, download', []),
+    ('import dlutils.pytorch', []),
+]
+
+_PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+%s
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [m for m in %r if m in sys.modules]]))
+'''
+
+
+def measure(statement, repeat):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    times = []
+    loaded = set()
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', _PROBE % (statement, HEAVY)], env=env)
+        elapsed, modules = json.loads(output.decode().strip().splitlines()[-1])
+        times.append(elapsed)
+        loaded.update(modules)
+    times.sort()
+    return times[len(times) // 2], times[0], sorted(loaded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dlutils import-time benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="number of fresh interpreters per statement")
+    parser.add_argument("--budget", type=float, default=None, help="fail if a median time exceeds this many ms")
+    args = parser.parse_args()
+
+    failed = False
+    print("%-60s %10s %10s  %s" % ('statement', 'median ms', 'best ms', 'heavy modules'))
+    for statement, allowed in CASES:
+        median, best, loaded = measure(statement, args.repeat)
+        unexpected = [m for m in loaded if m not in allowed]
+        over_budget = args.budget is not None and median * 1000.0 > args.budget
+        failed = failed or bool(unexpected) or over_budget
+        print("%-60s %10.1f %10.1f  %s%s" % (statement, median * 1000.0, best * 1000.0, ', '.join(loaded) or '-',
+                                            '  OVER BUDGET' if over_budget else ''))
+    if failed:
+        print("FAILED: heavy dependencies are imported eagerly or import time is over budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
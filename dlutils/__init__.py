@@ -13,28 +13,50 @@
 # limitations under the License.
 # ==============================================================================
 
-from dlutils.batch_provider import batch_provider
-from dlutils import download
-from dlutils import epoch
-from dlutils import measures
-from dlutils import random_rotation
-from dlutils import reader
-from dlutils import shuffle
-from dlutils import timer
-from dlutils.save_image import *
-from dlutils.cache import *
-from dlutils.async_calls import *
-from dlutils.default_cfg import *
-from dlutils.tracker import *
-from dlutils.block_process import block_process_2d
-from dlutils.numpy_dataset import NumpyDataset
-
-from dlutils.pytorch.jacobian import jacobian
-from dlutils.pytorch.count_parameters import count_parameters
-from dlutils.pytorch.launcher import run
-from dlutils.pytorch import lr_eq_adam
-from dlutils.pytorch import lr_eq_sgd
-from dlutils.pytorch import lr_eq
-from dlutils.pytorch.checkpointer import Checkpointer
+from dlutils import _lazy
 
 __version__ = '0.0.12'
+
+# Public names are resolved on first access, so that ``import dlutils`` does not pull torch, matplotlib, sklearn, scipy,
+# PIL and yacs until the code that needs them is actually used.
+_lazy.install(__name__, {
+    'batch_provider': ('dlutils.batch_provider', 'batch_provider'),
+    'block_process_2d': ('dlutils.block_process', 'block_process_2d'),
+    'NumpyDataset': ('dlutils.numpy_dataset', 'NumpyDataset'),
+    'save_image': ('dlutils.save_image', 'save_image'),
+    'make_grid': ('dlutils.save_image', 'make_grid'),
+    'cache': ('dlutils.cache', 'cache'),
+    'cache_stream': ('dlutils.cache', 'cache_stream'),
+    'register_codec': ('dlutils.storage', 'register_codec'),
+    'SampleCache': ('dlutils.cache', 'SampleCache'),
+    'async_func': ('dlutils.async_calls', 'async_func'),
+    'async_map': ('dlutils.async_calls', 'async_map'),
+    'async_gather': ('dlutils.async_calls', 'async_gather'),
+    'set_async_workers': ('dlutils.async_calls', 'set_async_workers'),
+    'set_async_processes': ('dlutils.async_calls', 'set_async_processes'),
+    'get_default_cfg': ('dlutils.default_cfg', 'get_default_cfg'),
+    'LossTracker': ('dlutils.tracker', 'LossTracker'),
+
+    'jacobian': ('dlutils.pytorch.jacobian', 'jacobian'),
+    'count_parameters': ('dlutils.pytorch.count_parameters', 'count_parameters'),
+    'run': ('dlutils.pytorch.launcher', 'run'),
+    'Checkpointer': ('dlutils.pytorch.checkpointer', 'Checkpointer'),
+    'lr_eq_adam': ('dlutils.pytorch.lr_eq_adam', None),
+    'lr_eq_sgd': ('dlutils.pytorch.lr_eq_sgd', None),
+    'lr_eq': ('dlutils.pytorch.lr_eq', None),
+
+    'async_calls': ('dlutils.async_calls', None),
+    'block_process': ('dlutils.block_process', None),
+    'default_cfg': ('dlutils.default_cfg', None),
+    'download': ('dlutils.download', None),
+    'epoch': ('dlutils.epoch', None),
+    'measures': ('dlutils.measures', None),
+    'numpy_dataset': ('dlutils.numpy_dataset', None),
+    'progress_bar': ('dlutils.progress_bar', None),
+    'pytorch': ('dlutils.pytorch', None),
+    'random_rotation': ('dlutils.random_rotation', None),
+    'reader': ('dlutils.reader', None),
+    'shuffle': ('dlutils.shuffle', None),
+    'timer': ('dlutils.timer', None),
+    'tracker': ('dlutils.tracker', None),
+})
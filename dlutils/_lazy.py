@@ -0,0 +1,66 @@
+# Copyright 2018-2020 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Lazy attribute loading for packages.
+
+Importing a package only registers the names it exports; the submodule that
+defines a name (and whatever heavy dependencies it pulls, like torch or
+matplotlib) is imported on first access of that name.
+"""
+
+import importlib
+import sys
+import types
+
+
+class _LazyModule(types.ModuleType):
+    def __getattr__(self, name):
+        # Called only when regular lookup fails, i.e. the name was not loaded yet
+        exports = self.__dict__.get('_exports', {})
+        if name not in exports:
+            raise AttributeError("module '%s' has no attribute '%s'" % (self.__name__, name))
+        module_name, attr = exports[name]
+        value = importlib.import_module(module_name)
+        if attr is not None:
+            value = getattr(value, attr)
+        self.__dict__[name] = value
+        return value
+
+    def __setattr__(self, name, value):
+        # The import system binds every loaded submodule as an attribute of its parent package. Some submodules share
+        # the name with the function or class they define (``dlutils.cache``, ``dlutils.batch_provider``,
+        # ``dlutils.pytorch.jacobian``, ...), and the public name must keep referring to that function or class no
+        # matter who imported the submodule first.
+        export = self.__dict__.get('_exports', {}).get(name)
+        if export is not None and export[1] is not None and isinstance(value, types.ModuleType) \
+                and value.__name__ == export[0]:
+            value = getattr(value, export[1])
+        super(_LazyModule, self).__setattr__(name, value)
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self.__dict__.get('_exports', {})))
+
+
+def install(name, exports):
+    """Makes package ``name`` load its exported names lazily.
+
+    Args:
+        name (str): Name of the package, usually ``__name__``.
+        exports (dict): Maps each public name to a tuple ``(module, attribute)``. If ``attribute`` is None, the name
+            refers to the module itself.
+    """
+    module = sys.modules[name]
+    module._exports = exports
+    module.__all__ = list(exports)
+    module.__class__ = _LazyModule
@@ -13,48 +13,534 @@
 # limitations under the License.
 # ==============================================================================
 
+import os
+import sys
+import io
+import pickle
+import logging
+import importlib
 import threading
+import collections
+import multiprocessing
+import concurrent.futures
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-__all__ = ['async_func']
+__all__ = ['async_func', 'async_map', 'async_gather', 'set_async_workers', 'set_async_processes']
+
+
+_executor = None
+_executor_pid = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+_process_executor = None
+_process_executor_pid = None
+_process_executor_workers = None
+
+# Arrays smaller than that are sent to worker processes through the pipe
+_SHARE_MIN_BYTES = 1 << 16
+
+
+def set_async_workers(max_workers):
+    """ Sets the number of threads of the shared pool that runs functions decorated with :func:`async_func`.
+
+    Calls that were already submitted finish on the old pool.
+
+    Args:
+        max_workers (int): Number of threads. None for the default of :class:`concurrent.futures.ThreadPoolExecutor`.
+    """
+    global _executor, _executor_workers
+    with _executor_lock:
+        old = _executor if _executor_pid == os.getpid() else None
+        _executor = None
+        _executor_workers = max_workers
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        # Threads do not survive fork, so child processes create their own pool
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=_executor_workers,
+                                                              thread_name_prefix='async_func')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def set_async_processes(max_processes):
+    """ Sets the number of worker processes of the shared pool that runs functions decorated with
+    :func:`async_func` with ``process=True``.
+
+    Calls that were already submitted finish on the old pool.
+
+    Args:
+        max_processes (int): Number of processes. None for the number of CPUs.
+    """
+    global _process_executor, _process_executor_workers
+    with _executor_lock:
+        old = _process_executor if _process_executor_pid == os.getpid() else None
+        _process_executor = None
+        _process_executor_workers = max_processes
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+def _get_process_executor():
+    global _process_executor, _process_executor_pid
+    with _executor_lock:
+        if _process_executor is None or _process_executor_pid != os.getpid():
+            # spawn, since forking a process that runs other threads is not safe
+            _process_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=_process_executor_workers, mp_context=multiprocessing.get_context('spawn'))
+            _process_executor_pid = os.getpid()
+        return _process_executor
+
+
+class _SharePickler(pickle.Pickler):
+    """ Pickler that moves large NumPy arrays to shared memory blocks instead of pickling their data """
+    def __init__(self, file):
+        super(_SharePickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.blocks = []
+
+    def persistent_id(self, obj):
+        if np is None or not isinstance(obj, np.ndarray) or obj.dtype.hasobject or obj.nbytes < _SHARE_MIN_BYTES:
+            return None
+        from multiprocessing import shared_memory
+        block = shared_memory.SharedMemory(create=True, size=obj.nbytes)
+        self.blocks.append(block)
+        view = np.ndarray(obj.shape, obj.dtype, buffer=block.buf)
+        view[...] = obj
+        del view
+        return block.name, obj.dtype, obj.shape
+
+
+class _ShareUnpickler(pickle.Unpickler):
+    """ Unpickler for :class:`_SharePickler`. If :attr:`copy` is set, arrays are copied out of the blocks and the blocks
+    are destroyed, otherwise arrays are views of the blocks, which are kept in :attr:`blocks`.
+    """
+    def __init__(self, file, copy):
+        super(_ShareUnpickler, self).__init__(file)
+        self.copy = copy
+        self.blocks = []
+
+    def persistent_load(self, pid):
+        name, dtype, shape = pid
+        from multiprocessing import shared_memory
+        block = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype, buffer=block.buf)
+        if self.copy:
+            array = array.copy()
+            block.close()
+            block.unlink()
+        else:
+            self.blocks.append(block)
+        return array
+
+
+def _share(obj):
+    """ Returns pickle of obj and list of shared memory blocks it refers to """
+    f = io.BytesIO()
+    pickler = _SharePickler(f)
+    try:
+        pickler.dump(obj)
+    except BaseException:
+        _release(pickler.blocks, unlink=True)
+        raise
+    return f.getvalue(), pickler.blocks
+
+
+def _release(blocks, unlink):
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            # Some array still refers to the block. It will be unmapped when the process exits
+            pass
+        if unlink:
+            block.unlink()
+
+
+class _FunctionRef(object):
+    """ Picklable reference to a module level function, which may be wrapped by :func:`async_func` """
+    def __init__(self, fnc):
+        if '<locals>' in fnc.__qualname__ or fnc.__name__ == '<lambda>':
+            raise ValueError("Function %s must be defined at module level to run in a process" % fnc.__qualname__)
+        self.module = fnc.__module__
+        self.qualname = fnc.__qualname__
+
+    def resolve(self):
+        obj = importlib.import_module(self.module)
+        for name in self.qualname.split('.'):
+            obj = getattr(obj, name)
+        if isinstance(obj, AsyncMethod):
+            obj = obj.callable
+        return obj
+
+
+def _process_call(ref, payload):
+    """ Runs in a worker process """
+    unpickler = _ShareUnpickler(io.BytesIO(payload), copy=False)
+    args, kwargs = unpickler.load()
+    result = ref.resolve()(*args, **kwargs)
+    del args, kwargs
+    payload, blocks = _share(result)
+    del result
+    # Blocks of the result are destroyed by the parent, after it copies the data
+    _release(blocks, unlink=False)
+    _release(unpickler.blocks, unlink=False)
+    return payload
 
 
 class AsyncCall(object):
-    def __init__(self, fnc, callback=None):
+    def __init__(self, fnc, callback=None, executor=None, semaphore=None, process=False):
         self.callable = fnc
         self.callback = callback
+        self.executor = executor
+        self.semaphore = semaphore
+        self.process = process
         self.result = None
+        self.future = None
+        self._retrieved = False
 
     def __call__(self, *args, **kwargs):
-        self.thread = threading.Thread(target=self.run, name=self.callable.__name__, args=args, kwargs=kwargs)
-        self.thread.start()
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        try:
+            if self.process:
+                self._submit_to_process(args, kwargs)
+            else:
+                executor = self.executor if self.executor is not None else _get_executor()
+                self.future = executor.submit(self.run, *args, **kwargs)
+        except BaseException:
+            if self.semaphore is not None:
+                self.semaphore.release()
+            raise
+        if self.semaphore is not None:
+            self.future.add_done_callback(lambda _: self.semaphore.release())
         return self
 
     def wait(self, timeout=None):
-        self.thread.join(timeout)
-        if self.thread.isAlive():
+        """ Returns the result of the call, or raises the exception that the call raised.
+
+        Raises:
+            TimeoutError: If the call did not finish in :attr:`timeout` seconds.
+        """
+        self._retrieved = True
+        try:
+            return self.future.result(timeout)
+        except concurrent.futures.TimeoutError:
             raise TimeoutError
-        else:
-            return self.result
+
+    def exception(self, timeout=None):
+        """ Returns the exception raised by the call, or None if it succeeded. Waits for the call to finish. """
+        self._retrieved = True
+        try:
+            return self.future.exception(timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError
+
+    def done(self):
+        return self.future.done()
+
+    def cancel(self):
+        """ Cancels the call, if it has not started yet. Returns True if cancelled. """
+        return self.future.cancel()
+
+    def cancelled(self):
+        return self.future.cancelled()
+
+    def __await__(self):
+        import asyncio
+        self._retrieved = True
+        return asyncio.wrap_future(self.future).__await__()
 
     def run(self, *args, **kwargs):
         self.result = self.callable(*args, **kwargs)
         if self.callback:
             self.callback(self.result)
+        return self.result
+
+    def __del__(self):
+        # Exceptions of calls that nobody waited for are logged, otherwise they would be lost silently
+        future = self.future
+        if self._retrieved or future is None or not future.done() or future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            logging.getLogger(__name__).error("Exception in asynchronous call of %s was never retrieved" %
+                                              getattr(self.callable, '__name__', self.callable),
+                                              exc_info=(type(e), e, e.__traceback__))
+
+    def _submit_to_process(self, args, kwargs):
+        ref = _FunctionRef(self.callable)
+        payload, blocks = _share((args, kwargs))
+        executor = self.executor if self.executor is not None else _get_process_executor()
+        try:
+            inner = executor.submit(_process_call, ref, payload)
+        except BaseException:
+            _release(blocks, unlink=True)
+            raise
+        # Outer future, that is resolved with the unpickled result. Cancelling either of them cancels the other one.
+        self.future = concurrent.futures.Future()
+
+        def done(f):
+            _release(blocks, unlink=True)
+            if f.cancelled():
+                self.future.cancel()
+                return
+            try:
+                # Unpickled even if the outer future was cancelled, to free shared memory of the result
+                result = _ShareUnpickler(io.BytesIO(f.result()), copy=True).load()
+                if self.future.cancelled():
+                    return
+                self.result = result
+                if self.callback:
+                    self.callback(self.result)
+            except BaseException as e:
+                if not self.future.cancelled():
+                    self.future.set_exception(e)
+            else:
+                self.future.set_result(self.result)
+
+        def outer_done(f):
+            if f.cancelled():
+                inner.cancel()
+
+        inner.add_done_callback(done)
+        self.future.add_done_callback(outer_done)
 
 
 class AsyncMethod(object):
-    def __init__(self, fnc, callback=None):
+    def __init__(self, fnc, callback=None, executor=None, max_in_flight=None, process=False):
+        if process and sys.version_info < (3, 8):
+            raise RuntimeError("async_func with process=True requires Python 3.8 or newer")
         self.callable = fnc
         self.callback = callback
+        self.executor = executor
+        self.process = process
+        self.semaphore = threading.BoundedSemaphore(max_in_flight) if max_in_flight is not None else None
 
     def __call__(self, *args, **kwargs):
-        return AsyncCall(self.callable, self.callback)(*args, **kwargs)
+        return AsyncCall(self.callable, self.callback, self.executor, self.semaphore, self.process)(*args, **kwargs)
+
+
+class _Map(object):
+    def __init__(self, fn, iterables, limit, ordered):
+        self.fn = fn if isinstance(fn, AsyncMethod) else AsyncMethod(fn)
+        self.items = zip(*iterables)
+        self.limit = limit
+        self.ordered = ordered
+        self.pending = collections.deque()
+        self.exhausted = False
+        self._fill()
+
+    def _fill(self):
+        while not self.exhausted and (self.limit is None or len(self.pending) < self.limit):
+            try:
+                args = next(self.items)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.pending.append(self.fn(*args))
+
+    def _take(self, call):
+        self.pending.remove(call)
+        try:
+            return call.wait()
+        except BaseException:
+            self.cancel()
+            raise
+        finally:
+            self._fill()
+
+    def cancel(self):
+        """ Cancels all calls that have not started yet and stops submitting new ones. """
+        self.exhausted = True
+        while self.pending:
+            self.pending.popleft().cancel()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.pending:
+            raise StopIteration
+        if self.ordered:
+            call = self.pending[0]
+        else:
+            done, _ = concurrent.futures.wait([c.future for c in self.pending],
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            call = next(c for c in self.pending if c.future in done)
+        return self._take(call)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        import asyncio
+        if not self.pending:
+            raise StopAsyncIteration
+        if self.ordered:
+            call = self.pending[0]
+            await asyncio.wait([asyncio.wrap_future(call.future)])
+        else:
+            wrapped = {asyncio.wrap_future(c.future): c for c in self.pending}
+            done, _ = await asyncio.wait(wrapped, return_when=asyncio.FIRST_COMPLETED)
+            call = wrapped[next(iter(done))]
+        return self._take(call)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cancel()
+
+    def __del__(self):
+        self.cancel()
+
+
+def async_map(fn, *iterables, limit=None, ordered=True):
+    """ Calls :attr:`fn` asynchronously for each set of arguments taken from :attr:`iterables`, like :func:`map`.
+
+    Keeps at most :attr:`limit` calls in flight, taking new arguments from :attr:`iterables` only as results are
+    consumed. Returns an iterator over results, which can be used both in regular ``for`` loops and in ``async for``
+    loops. If a call raises an exception, calls that have not started yet are cancelled and the exception is raised
+    by the iterator. Calls that have not started yet are also cancelled if the iterator is closed with
+    :meth:`cancel`, used as a context manager, or garbage collected.
+
+    Args:
+        fn (Callable): Function to call. Either a function decorated with :func:`async_func`, or a plain function,
+            which is then run on the shared thread pool.
+        *iterables: Iterables of arguments.
+        limit (int, optional): Maximum number of calls in flight. Defaults to None (submit all at once).
+        ordered (bool, optional): Yield results in order of arguments. Otherwise, yield them as calls complete.
+            Defaults to True.
+
+    Returns:
+        Iterator over results.
+
+    Example:
+
+        ::
+
+            def load(path):
+                with open(path, 'rb') as f:
+                    return f.read()
+
+            for content in dlutils.async_map(load, paths, limit=64, ordered=False):
+                ...
+
+            async def main():
+                async for content in dlutils.async_map(load, paths, limit=64):
+                    ...
+
+    """
+    return _Map(fn, iterables, limit, ordered)
+
+
+def async_gather(*calls, return_exceptions=False, timeout=None):
+    """ Waits for several calls made to functions decorated with :func:`async_func` and returns list of their results.
+
+    Calls are also awaitable, so in asyncio code ``await asyncio.gather(*calls)`` can be used instead.
+
+    Args:
+        *calls (AsyncCall): Calls to wait for.
+        return_exceptions (bool, optional): Put exceptions raised by calls to the list of results. Otherwise, the first
+            exception is raised as soon as it occurs and calls that have not started yet are cancelled. Defaults to
+            False.
+        timeout (float, optional): Maximum time to wait in seconds. When exceeded, calls that have not started yet are
+            cancelled and :class:`TimeoutError` is raised. Defaults to None.
+
+    Returns:
+        list: Results in order of calls.
+    """
+    futures = [c.future for c in calls]
+    for c in calls:
+        c._retrieved = True
+    return_when = concurrent.futures.ALL_COMPLETED if return_exceptions else concurrent.futures.FIRST_EXCEPTION
+    done, not_done = concurrent.futures.wait(futures, timeout, return_when=return_when)
+    # Some calls are not done either because of a failure or a timeout, in both cases the rest is not needed
+    for f in not_done:
+        f.cancel()
+    failed = [f for f in futures if f in done and not f.cancelled() and f.exception() is not None]
+    if failed and not return_exceptions:
+        raise failed[0].exception()
+    if not_done:
+        raise TimeoutError
+    results = []
+    for f in futures:
+        if f.cancelled():
+            results.append(concurrent.futures.CancelledError())
+        elif f.exception() is not None:
+            results.append(f.exception())
+        else:
+            results.append(f.result())
+    return results
+
+
+def async_func(fnc=None, callback=None, executor=None, max_in_flight=None, process=False):
+    """ Decorator that makes function run asynchronously.
+
+    Calling decorated function submits it to a thread pool and immediately returns an :class:`AsyncCall` object. Its
+    :meth:`AsyncCall.wait` method returns the result, or raises the exception raised by the function. The underlying
+    :class:`concurrent.futures.Future` is available as :attr:`AsyncCall.future`. If a call fails and its exception is
+    never retrieved with :meth:`AsyncCall.wait`, :meth:`AsyncCall.exception`, ``await`` or :func:`async_gather`, the
+    exception is logged when the call is garbage collected.
+
+    By default, all decorated functions share one thread pool, size of which can be changed with
+    :func:`dlutils.set_async_workers`.
+
+    CPU-bound functions can be run in a shared pool of persistent worker processes with ``process=True``, so that they
+    do not compete for the GIL with the main thread. Then arguments and results are pickled, except for large NumPy
+    arrays, which are passed through shared memory. Size of the pool can be changed with
+    :func:`dlutils.set_async_processes`.
+
+    Note:
+        Waiting for a call from inside another call that runs on the same pool can deadlock, if all threads of the pool
+        are busy waiting.
+
+        With ``process=True`` the function must be defined at module level, so that worker processes can import it,
+        and the main module must be guarded with ``if __name__ == '__main__':``, since workers are started with
+        'spawn' method.
+
+    Args:
+        fnc (function): function to decorate.
+        callback (Callable[[Any], None], optional): Called with the result in the worker thread. With
+            ``process=True`` it is called in a thread of the calling process. Defaults to None.
+        executor (concurrent.futures.Executor, optional): Executor to use instead of the shared pool. Defaults to None.
+        max_in_flight (int, optional): Maximum number of calls of this function that are submitted but not finished.
+            When reached, new calls block until one of the previous ones finishes. Defaults to None (no limit).
+        process (bool, optional): Run the function in a worker process instead of a thread. :attr:`executor`, if
+            given, must then be a :class:`concurrent.futures.ProcessPoolExecutor`. Requires Python 3.8 or newer, which
+            has :mod:`multiprocessing.shared_memory`. Defaults to False.
+
+    Example:
+
+        ::
+
+            @dlutils.async_func(max_in_flight=2)
+            def save(x, path):
+                np.save(path, x)
+
+            calls = [save(x, "%d.npy" % i) for i, x in enumerate(arrays)]
+            for call in calls:
+                call.wait()
+
+            @dlutils.async_func(process=True)
+            def render(images, filename):
+                dlutils.save_image(images, filename)
 
+            render(images, 'samples.png')
 
-def async_func(fnc=None, callback=None):
+    """
     if fnc is None:
         def add_async_callback(f):
-            return AsyncMethod(f, callback)
+            return AsyncMethod(f, callback, executor, max_in_flight, process)
         return add_async_callback
     else:
-        return AsyncMethod(fnc, callback)
+        return AsyncMethod(fnc, callback, executor, max_in_flight, process)
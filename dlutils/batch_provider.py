@@ -13,15 +13,18 @@
 # limitations under the License.
 # ==============================================================================
 
+import os
 try:
     from Queue import Queue, Empty
 except ImportError:
     from queue import Queue, Empty
 from threading import Thread, Lock, Event
 from .progress_bar import ProgressBar
+from .cache import SampleCache
 
 
-def batch_provider(data, batch_size, processor=None, worker_count=1, queue_size=16, report_progress=True):
+def batch_provider(data, batch_size, processor=None, worker_count=1, queue_size=16, report_progress=True,
+                   sample_processor=None, sample_cache=None, sample_key=None, cores=None):
     """ Return an object that produces a sequence of batches from input data
 
     Input data is split into batches of size :attr:`batch_size` which are processed with function :attr:`processor`
@@ -42,6 +45,10 @@ def batch_provider(data, batch_size, processor=None, worker_count=1, queue_size=
     - Augmenting data, flipping, rotating adding nose, etc.
     - Concatenation of data, stacking to single ndarray, conversion to a tensor, uploading to GPU.
     - Data generation.
+
+    Deterministic per-sample work, like reading and decoding, can be moved to :attr:`sample_processor` and cached on
+    disk with :attr:`sample_cache`. Then only the first epoch does that work, while on the later ones
+    :attr:`processor` receives cached samples and does only random augmentations and batching.
     
     Note:
         Sequential order of batches is guaranteed only if number of workers is 1 (Default), otherwise batches might
@@ -67,6 +74,19 @@ def batch_provider(data, batch_size, processor=None, worker_count=1, queue_size=
                     ...
 
             Defaults to True.
+        sample_processor (Callable[[Any], Any], optional): Function applied to each entry of :attr:`data` before
+            :attr:`processor`. Then :attr:`processor` receives list of its outputs instead of slice of :attr:`data`.
+            Defaults to None.
+        sample_cache (Union[str, SampleCache], optional): Cache for outputs of :attr:`sample_processor`, keyed by
+            :attr:`sample_key`. Either :class:`dlutils.SampleCache`, or path prefix to create one. See
+            :class:`dlutils.SampleCache` for requirements to the outputs. Defaults to None.
+        sample_key (Callable[[Any], int], optional): Returns stable id of an entry of :attr:`data`, an integer in range
+            ``[0, len(data))`` that must not change when :attr:`data` is reordered. Required with :attr:`sample_cache`.
+            The simplest way is to keep ``(index, item)`` pairs in :attr:`data`, shuffle the list of pairs between
+            epochs, and pass ``sample_key=lambda x: x[0]``. Never key by position in :attr:`data`, shuffled data
+            would receive cached samples of other entries. Defaults to None.
+        cores (list, optional): Pin worker threads to these CPU cores, e.g. cores reserved for data loading by
+            :func:`dlutils.run`, so that they do not compete with compute threads. Linux only. Defaults to None.
 
     Returns:
         Iterator: An object that produces a sequence of batches. :meth:`next()` method of the iterator will return
@@ -97,6 +117,27 @@ def batch_provider(data, batch_size, processor=None, worker_count=1, queue_size=
                 loss.backward()
                 optimizer.step()
 
+        With per-sample cache. Entries carry their index in the original list, so that they can be shuffled:
+
+        ::
+
+            data = list(enumerate(data))
+
+            def decode(x):
+                filename, label = x[1]
+                return np.asarray(Image.open(filename).resize((64, 64)), dtype=np.uint8), np.int64(label)
+
+            def augment(samples):
+                images = np.stack([random_crop(image) for image, _ in samples])
+                labeles = np.stack([label for _, label in samples])
+                return torch.from_numpy(images), torch.from_numpy(labeles)
+
+            for epoch in range(epochs):
+                random.shuffle(data)
+                batches = dlutils.batch_provider(data, 32, augment, sample_processor=decode,
+                                                 sample_cache='.cache/train_64', sample_key=lambda x: x[0])
+                ...
+
 
     """
     class State:
@@ -138,11 +179,26 @@ def batch_provider(data, batch_size, processor=None, worker_count=1, queue_size=
         def processor(x):
             return x
 
+    if sample_cache is not None and sample_key is None:
+        raise ValueError("sample_key is required with sample_cache, position in data is not a stable key")
+    if isinstance(sample_cache, str):
+        sample_cache = SampleCache(sample_cache, len(data))
+
+    def _process_sample(item):
+        if sample_cache is None:
+            return sample_processor(item)
+        return sample_cache.get(sample_key(item), lambda: sample_processor(item))
+
     def _worker(state):
+        if cores and hasattr(os, 'sched_setaffinity'):
+            # Sets affinity of the calling thread only
+            os.sched_setaffinity(0, cores)
         while not state.quit_event.is_set():
             try:
                 cb = state.get_next_batch_it()
                 data_slice = data[cb * batch_size:min((cb + 1) * batch_size, state.data_len)]
+                if sample_processor is not None:
+                    data_slice = [_process_sample(x) for x in data_slice]
                 b = processor(data_slice)
                 state.push_done_batch(b)
             except StopIteration:
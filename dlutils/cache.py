@@ -16,25 +16,706 @@
 
 import hashlib
 import pickle
+import io
 import os
+import struct
+import sys
+import glob
+import time
+import sqlite3
+import threading
+import atexit
+import logging
+import inspect
+import weakref
+import marshal
+import mmap
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+from dlutils.storage import register_codec, get_codec, fast_hash, temp_suffix, MIN_SAVING
 
 
-class cache:
+__all__ = ['cache', 'cache_stream', 'register_codec', 'SampleCache']
+
+
+def _default_root():
+    return os.environ.get('DLUTILS_CACHE_DIR', '.cache')
+
+
+# Access times of entries are recorded with this granularity in seconds, so that most cache hits do not write to the
+# index, which is shared by all processes
+_TOUCH_INTERVAL = 60.0
+# Maximum number of entries, for which the last recorded access is remembered by a process
+_TOUCHED_MAX = 1 << 16
+
+
+class _CacheIndex(object):
+    """ Small sqlite index of the entries stored under a cache root.
+
+    For every entry it keeps its size and the time of the last access, plus the running total of all sizes, so that
+    eviction never has to list or stat the cache directory. Access times are updated at most once per
+    ``_TOUCH_INTERVAL`` seconds, which is precise enough for eviction.
+    """
+    def __init__(self, root):
+        self.path = os.path.join(root, 'index.db')
+        self.lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        # path -> (recorded access time, compute time)
+        self._touched = dict()
+
+    def _connect(self):
+        # sqlite connections must not be shared with forked children
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=60.0, check_same_thread=False)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                               '(path TEXT PRIMARY KEY, size INTEGER, accessed REAL, compute REAL)')
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(entries)')]
+            if 'compute' not in columns:
+                connection.execute('ALTER TABLE entries ADD COLUMN compute REAL')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+            connection.execute('CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY, size INTEGER)')
+            connection.execute('INSERT OR IGNORE INTO total VALUES (0, 0)')
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def touch(self, path):
+        """ Updates access time of the entry and returns time it took to compute it, if known """
+        now = time.time()
+        with self.lock:
+            touched = self._touched.get(path)
+            if touched is not None and now - touched[0] < _TOUCH_INTERVAL:
+                return touched[1]
+            connection = self._connect()
+            row = connection.execute('SELECT accessed, compute FROM entries WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                return None
+            accessed, compute_time = row
+            # Some other process could have recorded a recent access already
+            if accessed is None or now - accessed >= _TOUCH_INTERVAL:
+                with connection:
+                    connection.execute('UPDATE entries SET accessed = ? WHERE path = ?', (now, path))
+                accessed = now
+            if len(self._touched) >= _TOUCHED_MAX:
+                self._touched.clear()
+            self._touched[path] = (accessed, compute_time)
+        return compute_time
+
+    def add(self, path, size, compute_time=None):
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                row = connection.execute('SELECT size FROM entries WHERE path = ?', (path,)).fetchone()
+                old_size = row[0] if row is not None else 0
+                connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                                   (path, size, time.time(), compute_time))
+                connection.execute('UPDATE total SET size = size + ? WHERE id = 0', (size - old_size,))
+            self._touched.pop(path, None)
+
+    def total_size(self):
+        with self.lock:
+            return self._connect().execute('SELECT size FROM total WHERE id = 0').fetchone()[0]
+
+    def pop_evicted(self, max_bytes=None, max_age=None):
+        """ Removes from the index entries that exceed the budget and returns their paths.
+
+        Entries that were not accessed for more than :attr:`max_age` seconds are evicted first, then the least
+        recently used ones until the total size fits into :attr:`max_bytes`.
+        """
+        evicted = []
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                if max_age is not None:
+                    rows = connection.execute('SELECT path, size FROM entries WHERE accessed < ?',
+                                              (time.time() - max_age,)).fetchall()
+                    evicted += rows
+                if max_bytes is not None:
+                    total = connection.execute('SELECT size FROM total WHERE id = 0').fetchone()[0]
+                    total -= sum(size for _, size in evicted)
+                    if total > max_bytes:
+                        skip = set(path for path, _ in evicted)
+                        for path, size in connection.execute('SELECT path, size FROM entries ORDER BY accessed'):
+                            if total <= max_bytes:
+                                break
+                            if path in skip:
+                                continue
+                            evicted.append((path, size))
+                            total -= size
+                for path, size in evicted:
+                    connection.execute('DELETE FROM entries WHERE path = ?', (path,))
+                    self._touched.pop(path, None)
+                connection.execute('UPDATE total SET size = size - ? WHERE id = 0',
+                                   (sum(size for _, size in evicted),))
+        return [path for path, _ in evicted]
+
+
+def _lock_file(fd, blocking=True):
+    """ Returns False if blocking is False and the lock is taken by someone else """
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+    else:
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+
+
+def _unlock_file(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class _FileLock(object):
+    """ Exclusive inter-process lock on a file. Also excludes threads of the same process, since every acquire opens
+    the file anew.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                locked = _lock_file(fd, blocking)
+            except BaseException:
+                os.close(fd)
+                raise
+            if not locked:
+                os.close(fd)
+                return False
+            # The lock file could have been removed by eviction while we were waiting, then the lock is useless
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    self.fd = fd
+                    return True
+            except FileNotFoundError:
+                pass
+            _unlock_file(fd)
+            os.close(fd)
+
+    def release(self):
+        _unlock_file(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class _CacheStore(object):
+    """ Directory layout of a cache root.
+
+    Entries are sharded into two levels of subdirectories by the first four hex digits of their hash, e.g.
+    ``.cache/3f/a2/3fa2..._function_name.pkl``, which keeps every directory small even with millions of entries.
+    All files that belong to an entry share the same stem, so the whole entry can be removed by the stem.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.index = _CacheIndex(root)
+
+    def entry_stem(self, digest, name):
+        return os.path.join(digest[0:2], digest[2:4], "%s_%s" % (digest, name))
+
+    def full_path(self, stem, suffix=''):
+        return os.path.join(self.root, stem + suffix)
+
+    def lock(self, stem):
+        return _FileLock(self.full_path(stem, '.lock'))
+
+    def entry_size(self, stem):
+        return sum(os.path.getsize(p) for p in glob.glob(glob.escape(self.full_path(stem)) + '.*'))
+
+    def remove(self, stem):
+        for p in glob.glob(glob.escape(self.full_path(stem)) + '.*'):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def evict(self, max_bytes=None, max_age=None):
+        if max_bytes is None and max_age is None:
+            return
+        for stem in self.index.pop_evicted(max_bytes, max_age):
+            self.remove(stem)
+
+
+# Arrays smaller than this are cheaper to keep inline in the pickle than in a separate file
+_ARRAY_MIN_BYTES = 1 << 16
+
+
+def _as_array(obj, min_bytes=_ARRAY_MIN_BYTES):
+    """ Returns tuple (kind, ndarray) if obj should be handled as a raw array, otherwise None """
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject or obj.nbytes < min_bytes:
+            return None
+        return 'numpy', obj
+    torch = sys.modules.get('torch')
+    if torch is not None and isinstance(obj, torch.Tensor):
+        if obj.is_sparse or obj.numel() * obj.element_size() < min_bytes:
+            return None
+        try:
+            return 'torch', obj.detach().cpu().numpy()
+        except (TypeError, RuntimeError):
+            # dtypes that numpy does not support, e.g. bfloat16
+            return None
+    return None
+
+
+def _bytes_view(array):
+    # Buffers of some dtypes, e.g. datetime64, can't be exported directly
+    return np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+
+
+class _ArrayPickler(pickle.Pickler):
+    def __init__(self, file, path):
+        super(_ArrayPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.path = path
+        self.saved = dict()
+
+    def persistent_id(self, obj):
+        if id(obj) in self.saved:
+            return self.saved[id(obj)][0]
+        array = _as_array(obj)
+        if array is None:
+            return None
+        kind, array = array
+        pid = (kind, len(self.saved))
+        # Write to a temporary file and rename, so that readers that have the old file mapped are not affected
+        path = self.path + '.%d.npy' % pid[1]
+        temp = path + temp_suffix()
+        try:
+            with open(temp, 'wb') as f:
+                np.save(f, array, allow_pickle=False)
+            os.replace(temp, path)
+        except Exception:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        # keep reference, so that id is not reused
+        self.saved[id(obj)] = (pid, obj)
+        return pid
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    def __init__(self, file, path):
+        super(_ArrayUnpickler, self).__init__(file)
+        self.path = path
+        self.loaded = dict()
+
+    def persistent_load(self, pid):
+        if pid in self.loaded:
+            return self.loaded[pid]
+        kind, i = pid
+        if kind == 'torch':
+            import torch
+            # copy-on-write mapping, since torch expects writable memory
+            obj = torch.from_numpy(np.load(self.path + '.%d.npy' % i, mmap_mode='c'))
+        else:
+            obj = np.load(self.path + '.%d.npy' % i, mmap_mode='r')
+        self.loaded[pid] = obj
+        return obj
+
+
+def _dump(f, data, path, serializer):
+    if serializer == 'array':
+        _ArrayPickler(f, path).dump(data)
+    else:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load(f, path, serializer):
+    if serializer == 'array':
+        return _ArrayUnpickler(f, path).load()
+    else:
+        return pickle.load(f)
+
+
+class _ByteCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def write(self, b):
+        self.count += len(b)
+
+
+class _SizePickler(pickle.Pickler):
+    """ Measures size of data as pickled by the 'array' serializer, without writing arrays anywhere """
+    def __init__(self, file):
+        super(_SizePickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.array_bytes = 0
+
+    def persistent_id(self, obj):
+        array = _as_array(obj)
+        if array is None:
+            return None
+        self.array_bytes += array[1].nbytes
+        return id(obj)
+
+
+def _nbytes(data):
+    counter = _ByteCounter()
+    pickler = _SizePickler(counter)
+    pickler.dump(data)
+    return counter.count + pickler.array_bytes
+
+
+# Pickles never start with this byte
+_CODEC_MAGIC = b'\xdcDLC'
+
+# Data larger than that is checked for compressibility on a sample, before compressing all of it
+_SAMPLE_BYTES = 1 << 18
+
+def _encode(raw, compression, level):
+    """ Compresses raw pickle if it pays off. Returns bytes to be written. """
+    codec = get_codec(compression)
+    if len(raw) > 4 * _SAMPLE_BYTES:
+        offset = (len(raw) - _SAMPLE_BYTES) // 2
+        sample = raw[offset:offset + _SAMPLE_BYTES]
+        if len(codec.compress(sample, level)) > (1.0 - MIN_SAVING) * len(sample):
+            return raw
+    compressed = codec.compress(raw, level)
+    if len(compressed) > (1.0 - MIN_SAVING) * len(raw):
+        return raw
+    name = compression.encode('ascii')
+    return b''.join([_CODEC_MAGIC, bytes([len(name)]), name, compressed])
+
+
+def _decode(data):
+    """ Returns raw pickle, decompressing it if data was compressed. """
+    if not data.startswith(_CODEC_MAGIC):
+        return data
+    name_len = data[len(_CODEC_MAGIC)]
+    start = len(_CODEC_MAGIC) + 1
+    name = bytes(data[start:start + name_len]).decode('ascii')
+    codec = get_codec(name)
+    if codec is None:
+        raise pickle.UnpicklingError("Entry is compressed with unknown codec: %s" % name)
+    try:
+        return codec.decompress(data[start + name_len:])
+    except codec.errors as e:
+        raise pickle.UnpicklingError("Can't decompress entry: %s" % e)
+
+
+class CacheStats(object):
+    """ Statistics of a cached function.
+
+    Attributes:
+        hits (int): Number of calls served from the cache.
+        misses (int): Number of calls that computed the result.
+        errors (int): Number of entries that could not be read, e.g. corrupted or not unpicklable, and were recomputed.
+        bytes_read (int): Bytes read from pickles on hits. Memory-mapped arrays are not counted, since they are read
+            on access.
+        bytes_written (int): Bytes written on misses, including arrays stored by the 'array' serializer.
+        raw_bytes (int): Size of written pickles before compression.
+        stored_bytes (int): Size of written pickles after compression.
+        load_time (float): Total time in seconds spent on serving hits.
+        decode_time (float): Total time in seconds spent on decompressing and unpickling cache hits.
+        compute_time (float): Total time in seconds spent on calling the function on misses.
+        time_saved (float): Total time in seconds saved by hits, which is time it took to compute each entry minus time
+            to load it. Negative value means that loading is slower than computing. Entries written by older versions
+            do not record compute time and are not counted.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.load_time = 0.0
+        self.decode_time = 0.0
+        self.compute_time = 0.0
+        self.time_saved = 0.0
+
+    def add(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    @property
+    def compression_ratio(self):
+        """ Ratio of raw size to stored size of written pickles. """
+        return self.raw_bytes / self.stored_bytes if self.stored_bytes else 1.0
+
+    @property
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else 0.0
+
+    def __str__(self):
+        return "hits: %d, misses: %d, errors: %d, hit rate: %.1f%%, read: %.1fMB, written: %.1fMB, " \
+               "load: %.3fs, compute: %.3fs, saved: %.3fs, compression: %.2fx" % (
+                self.hits, self.misses, self.errors, self.hit_rate * 100.0, self.bytes_read / 1024 ** 2,
+                self.bytes_written / 1024 ** 2, self.load_time, self.compute_time, self.time_saved,
+                self.compression_ratio)
+
+
+# id(array) -> (weakref to array, digest). Only arrays whose contents can't change are memoized
+_digests = dict()
+_digests_lock = threading.Lock()
+
+
+def _is_immutable(array):
+    """ Returns True if contents of array can never change, like memory-mapped cache hits.
+
+    Read-only flag alone is not enough, since numpy allows to make an array that owns its data writable again. So the
+    array and all arrays it is a view of must be read-only, and the memory must belong to a buffer that can't be made
+    writable, like a read-only ``mmap`` or ``bytes``.
+
+    Tensors are never memoized: writes through ``tensor.data`` or ``tensor.numpy()`` do not bump the version counter,
+    so there is no cheap way to tell whether their contents changed.
+    """
+    while isinstance(array, np.ndarray):
+        if array.flags.writeable or array.base is None:
+            return False
+        array = array.base
+    if not isinstance(array, (bytes, mmap.mmap)):
+        return False
+    with memoryview(array) as view:
+        return view.readonly
+
+
+def _forget_digest(key):
+    with _digests_lock:
+        _digests.pop(key, None)
+
+
+def _array_digest(array):
+    memoize = _is_immutable(array)
+    key = id(array)
+    if memoize:
+        with _digests_lock:
+            memo = _digests.get(key)
+        if memo is not None and memo[0]() is array:
+            return memo[1]
+    m = fast_hash()
+    m.update(_bytes_view(array))
+    digest = m.digest()
+    if memoize:
+        ref = weakref.ref(array, lambda _, key=key: _forget_digest(key))
+        with _digests_lock:
+            _digests[key] = (ref, digest)
+    return digest
+
+
+class _HashWriter(object):
+    def __init__(self):
+        self.m = hashlib.sha256()
+
+    def write(self, b):
+        self.m.update(b)
+
+
+class _KeyPickler(pickle.Pickler):
+    """ Pickles arguments straight into a hash, replacing arrays and tensors with the hash of their buffer """
+    def __init__(self, file):
+        # Fixed protocol, so that keys do not change with python version
+        super(_KeyPickler, self).__init__(file, protocol=4)
+
+    def persistent_id(self, obj):
+        if isinstance(obj, np.ndarray):
+            # Checked before any conversion, so that a memoized array costs nothing
+            if obj.dtype.hasobject:
+                return None
+            return 'numpy', obj.dtype.str, obj.shape, _array_digest(obj)
+        array = _as_array(obj, min_bytes=0)
+        if array is None:
+            return None
+        kind, array = array
+        return kind, array.dtype.str, array.shape, _array_digest(array)
+
+
+def _source_hash(function):
+    m = hashlib.sha256()
+    try:
+        m.update(inspect.getsource(function).encode('utf-8'))
+    except (OSError, TypeError):
+        code = getattr(function, '__code__', None)
+        if code is None:
+            raise ValueError("Can't get source or bytecode of %s" % function)
+        m.update(marshal.dumps(code))
+    return m.hexdigest()
+
+
+# Returned by cache._try_load if entry is missing or can't be read
+_MISS = object()
+_CORRUPTED = object()
+
+
+_stores = dict()
+_stores_lock = threading.Lock()
+
+
+class _Writer(object):
+    """ Background thread that persists cache entries in write-behind mode """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        self.pid = None
+
+    def submit(self, job):
+        with self.lock:
+            # Threads do not survive fork, so child processes start their own writer
+            if self.thread is None or self.pid != os.getpid():
+                self.queue = Queue()
+                self.thread = threading.Thread(target=self._run, args=(self.queue,), name='dlutils.cache writer')
+                self.thread.daemon = True
+                self.thread.start()
+                self.pid = os.getpid()
+            queue = self.queue
+        queue.put(job)
+
+    @staticmethod
+    def _run(queue):
+        while True:
+            job = queue.get()
+            try:
+                job()
+            except Exception:
+                logging.getLogger(__name__).exception("Failed to write cache entry")
+            finally:
+                queue.task_done()
+
+    def flush(self):
+        with self.lock:
+            queue = self.queue if self.pid == os.getpid() else None
+        if queue is not None:
+            queue.join()
+
+
+_writer = _Writer()
+atexit.register(_writer.flush)
+
+
+def flush():
+    """ Blocks until all cache entries queued in write-behind mode are written to disk.
+
+    It is called automatically on interpreter exit.
+    """
+    _writer.flush()
+
+
+_instances = weakref.WeakSet()
+
+
+def report():
+    """ Returns a table with statistics of all cached functions of this process.
+
+    Example:
+
+        ::
+
+            >>> print(dlutils.cache.report())
+            function              hits  misses  errors   read MB  written MB    load s  compute s    saved s
+            load_dataset            12       1       0       0.1      3051.8     0.012     95.331   1143.960
+            expensive_function       3       3       0       0.0         0.0     0.001      0.000     -0.001
+
+    """
+    rows = sorted(_instances, key=lambda x: x.function.__qualname__)
+    width = max([len('function')] + [len(x.function.__qualname__) for x in rows])
+    lines = ['%-*s  %6s  %6s  %6s  %8s  %10s  %8s  %9s  %9s' % (
+        width, 'function', 'hits', 'misses', 'errors', 'read MB', 'written MB', 'load s', 'compute s', 'saved s')]
+    for x in rows:
+        s = x.stats
+        lines.append('%-*s  %6d  %6d  %6d  %8.1f  %10.1f  %8.3f  %9.3f  %9.3f' % (
+            width, x.function.__qualname__, s.hits, s.misses, s.errors, s.bytes_read / 1024 ** 2,
+            s.bytes_written / 1024 ** 2, s.load_time, s.compute_time, s.time_saved))
+    return '\n'.join(lines)
+
+
+def _get_store(root):
+    root = os.path.abspath(root)
+    with _stores_lock:
+        if root not in _stores:
+            _stores[root] = _CacheStore(root)
+        return _stores[root]
+
+
+class cache(object):
     """ Caches return value of a functions.
 
     Given a function with no side effects, it will compute sha256 hash of passed arguments and use that hash to retrieve
-    saved pickle.
+    saved pickle. NumPy arrays and torch tensors in arguments are not pickled, instead their buffers are hashed directly
+    with a fast hash (xxhash if installed, otherwise blake2b). Hashes of arrays backed by read-only memory, like
+    memory-mapped cache hits, are memoized, so passing the same large array again costs nothing. Tensors and other
+    arrays are hashed on every call.
+
+    Can be used directly as a decorator, or called with keyword arguments to configure the cache.
 
     Note:
-        
+
         Passed arguments must be picklable.
-        
+
         If you change function, or do any other change that invalidates previously saved caches you will need to delete
-        them manually
-        
-        Results are saved to '.cache' folder in current directory.
+        them manually, unless :attr:`hash_source` is set. Note, that :attr:`hash_source` only tracks the source of the
+        decorated function itself, not of the functions it calls.
+
+        Results are saved to '.cache' folder in current directory, unless :attr:`root` is given or ``DLUTILS_CACHE_DIR``
+        environment variable is set. Entries are sharded into two levels of subdirectories by hash. Size and last
+        access time of every entry are tracked in ``index.db`` file in the root, which is used for eviction.
+
+        It is safe to call the same cached function from several processes, e.g. from all ranks spawned by
+        :func:`dlutils.run`. On a miss, a per-entry file lock is taken, so only one process computes the result while
+        others wait and then read it. Entries are written to a temporary file and renamed, so readers never see a
+        partially written entry.
     Args:
         function (function): fucntions to be called.
+        root (str, optional): Directory where cache entries are stored. Defaults to ``DLUTILS_CACHE_DIR`` environment
+            variable or '.cache'.
+        max_bytes (int, optional): Size budget of the cache root in bytes. When exceeded after a write, least recently
+            used entries are evicted. Defaults to None (no limit).
+        max_age (float, optional): Entries that were not accessed for more than this number of seconds are evicted.
+            Defaults to None (no limit).
+        serializer (str, optional): 'pickle' to pickle the whole return value, or 'array' to store large NumPy arrays
+            and torch tensors found in the return value as raw `.npy` files next to the pickle. With 'array', cache
+            hits return arrays as read-only :class:`numpy.memmap` (tensors are backed by a copy-on-write mapping), so
+            nothing is read until accessed and pages are shared between processes. Defaults to 'pickle'.
+        hash_source (bool, optional): Include hash of the function source (or bytecode, if source is not available)
+            into the key, so that editing the function invalidates its entries. Defaults to False.
+        compression (str, optional): Name of the codec to compress entries with: 'zlib', 'lzma', 'bz2' or one added
+            with :func:`dlutils.cache.register_codec`. Entries that do not compress well are stored uncompressed. With
+            'array' serializer only the pickle is compressed, while arrays stay raw, so that they can be memory-mapped.
+            Defaults to None (no compression).
+        compression_level (int, optional): Compression level passed to the codec. Defaults to the codec default.
+        write_behind (bool, optional): On a miss, return the result immediately and write it to disk in a background
+            thread. With 'pickle' serializer the result is pickled before returning, so it may be modified afterwards.
+            With 'array' serializer arrays are written from the returned objects, so they must not be modified in
+            place until written. Pending writes are flushed on interpreter exit, or by calling
+            :meth:`dlutils.cache.flush`. Defaults to False.
+        max_inflight_bytes (int, optional): In write-behind mode, the maximum size of results of this function that
+            are waiting to be written. When exceeded, calls block until enough data is written. A single result that is
+            larger than the budget is still accepted when nothing else is pending. Defaults to 1 GiB.
 
     Example:
 
@@ -46,26 +727,549 @@ class cache:
                     x = x + x * x
                 return x
 
+            @dlutils.cache(root='/tmp/my_cache', max_bytes=10 * 1024 ** 3, max_age=7 * 24 * 3600)
+            def another_expensive_function(x):
+                ...
+
+            @dlutils.cache(serializer='array')
+            def load_dataset(path):
+                ...
+                return dict(images=images, labels=labels)
+
+            @dlutils.cache(compression='zlib', compression_level=1)
+            def compute_masks(path):
+                ...
+
+            print(compute_masks.stats.compression_ratio)
+
 
     """
-    def __init__(self, function):
+    def __new__(cls, function=None, **kwargs):
+        if function is None:
+            def decorator(f):
+                return cls(f, **kwargs)
+            return decorator
+        return super(cache, cls).__new__(cls)
+
+    register_codec = staticmethod(register_codec)
+    flush = staticmethod(flush)
+    report = staticmethod(report)
+
+    def __init__(self, function, root=None, max_bytes=None, max_age=None, serializer='pickle', hash_source=False,
+                 compression=None, compression_level=None, write_behind=False, max_inflight_bytes=1 << 30):
+        if serializer not in ('pickle', 'array'):
+            raise ValueError("Unknown serializer: %s" % serializer)
+        if compression is not None and get_codec(compression) is None:
+            raise ValueError("Unknown codec: %s" % compression)
+        self.compression = compression
+        self.compression_level = compression_level
+        self.stats = CacheStats()
         self.function = function
+        self.serializer = serializer
         self.pickle_name = self.function.__name__
+        self.store = _get_store(root if root is not None else _default_root())
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.source_hash = _source_hash(function) if hash_source else None
+        self.write_behind = write_behind
+        self.max_inflight_bytes = max_inflight_bytes
+        self.inflight_bytes = 0
+        self.inflight_cv = threading.Condition()
+        # stem -> (result, its pickle or None), for results that are not written yet
+        self.pending = dict()
+        _instances.add(self)
+
+    def key(self, *args, **kwargs):
+        """ Returns hex digest that identifies call with given arguments. """
+        writer = _HashWriter()
+        # kwargs are sorted, since order of a frozenset of strings changes with the hash seed
+        _KeyPickler(writer).dump((self.function.__name__, self.source_hash, args, sorted(kwargs.items())))
+        return writer.m.hexdigest()
 
     def __call__(self, *args, **kwargs):
-        m = hashlib.sha256()
-        m.update(pickle.dumps((self.function.__name__, args, frozenset(kwargs.items()))))
-        output_path = os.path.join('.cache', "%s_%s" % (m.hexdigest(), self.pickle_name))
-        try:
-            with open(output_path, 'rb') as f:
-                data = pickle.load(f)
-        except (FileNotFoundError, pickle.PickleError):
-            data = self.function(*args, **kwargs)
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            with open(output_path, 'wb') as f:
-                pickle.dump(data, f)
+        stem = self.store.entry_stem(self.key(*args, **kwargs), self.pickle_name)
+        with self.inflight_cv:
+            pending = self.pending.get(stem)
+        if pending is not None:
+            self.stats.add(hits=1)
+            data, raw = pending
+            # Pickled result is unpickled, so that hits get their own copy, like hits of written entries. The first
+            # caller may have modified the object it got
+            return pickle.loads(raw) if raw is not None else data
+        start = time.perf_counter()
+        data = self._try_load(stem)
+        if data is _MISS or data is _CORRUPTED:
+            lock = self.store.lock(stem)
+            lock.acquire()
+            try:
+                # Some other process could have computed it while we were waiting for the lock
+                data = self._try_load(stem, report=data is _MISS)
+                if data is _MISS or data is _CORRUPTED:
+                    start = time.perf_counter()
+                    data = self.function(*args, **kwargs)
+                    compute_time = time.perf_counter() - start
+                    self.stats.add(misses=1, compute_time=compute_time)
+                    if self.write_behind:
+                        # The lock is passed to the writer, which releases it once the entry is written
+                        self._save_behind(stem, data, lock, compute_time)
+                        lock = None
+                    else:
+                        self._save(stem, data, compute_time=compute_time)
+                    return data
+            finally:
+                if lock is not None:
+                    lock.release()
+        load_time = time.perf_counter() - start
+        compute_time = self.store.index.touch(stem)
+        self.stats.add(hits=1, load_time=load_time,
+                       time_saved=compute_time - load_time if compute_time is not None else 0.0)
         return data
 
+    def _try_load(self, stem, report=True):
+        try:
+            return self._load(stem)
+        except FileNotFoundError:
+            return _MISS
+        except Exception as e:
+            if report:
+                self.stats.add(errors=1)
+                logging.getLogger(__name__).warning("Can't load cache entry %s, recomputing. %s: %s" % (
+                    self.store.full_path(stem, '.pkl'), e.__class__.__name__, e))
+            return _CORRUPTED
+
+    def _save_behind(self, stem, data, lock, compute_time):
+        if self.serializer == 'pickle':
+            raw = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            size = len(raw)
+        else:
+            raw = None
+            size = _nbytes(data)
+
+        with self.inflight_cv:
+            while self.inflight_bytes > 0 and self.inflight_bytes + size > self.max_inflight_bytes:
+                self.inflight_cv.wait()
+            self.inflight_bytes += size
+            self.pending[stem] = (data, raw)
+
+        def job():
+            try:
+                self._save(stem, data, raw, compute_time)
+            finally:
+                lock.release()
+                with self.inflight_cv:
+                    self.inflight_bytes -= size
+                    del self.pending[stem]
+                    self.inflight_cv.notify_all()
+
+        _writer.submit(job)
+
+    def _load(self, stem):
+        path = self.store.full_path(stem)
+        with open(path + '.pkl', 'rb') as f:
+            start = time.perf_counter()
+            if self.compression is None and f.peek(len(_CODEC_MAGIC))[:len(_CODEC_MAGIC)] != _CODEC_MAGIC:
+                # Entries are still checked for a codec header, since compression could have been switched off
+                data = _load(f, path, self.serializer)
+            else:
+                data = _load(io.BytesIO(_decode(f.read())), path, self.serializer)
+            self.stats.add(decode_time=time.perf_counter() - start, bytes_read=f.tell())
+            return data
+
+    def _save(self, stem, data, raw=None, compute_time=None):
+        path = self.store.full_path(stem)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = path + '.pkl' + temp_suffix()
+        try:
+            with open(temp, 'wb') as f:
+                if self.compression is None and raw is None:
+                    _dump(f, data, path, self.serializer)
+                    self.stats.add(raw_bytes=f.tell(), stored_bytes=f.tell())
+                else:
+                    if raw is None:
+                        buffer = io.BytesIO()
+                        _dump(buffer, data, path, self.serializer)
+                        raw = buffer.getbuffer()
+                    encoded = raw if self.compression is None else _encode(raw, self.compression,
+                                                                           self.compression_level)
+                    f.write(encoded)
+                    self.stats.add(raw_bytes=len(raw), stored_bytes=len(encoded))
+                    del raw, encoded
+            os.replace(temp, path + '.pkl')
+        except Exception:
+            # Files of a failed entry are not in the index, so eviction would never remove them. The entry lock is held,
+            # so array files with this stem can only be the ones written by this call
+            if os.path.exists(temp):
+                os.remove(temp)
+            for p in glob.glob(glob.escape(path) + '.*.npy'):
+                os.remove(p)
+            raise
+        size = self.store.entry_size(stem)
+        self.stats.add(bytes_written=size)
+        self.store.index.add(stem, size, compute_time)
+        self.store.evict(self.max_bytes, self.max_age)
+
+
+_STREAM_MAGIC = b'DLS\x01'
+# Array data in streams is aligned to this number of bytes
+_STREAM_ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + _STREAM_ALIGNMENT - 1) // _STREAM_ALIGNMENT * _STREAM_ALIGNMENT
+
+
+class _StreamPickler(pickle.Pickler):
+    """ Pickles a chunk, writing its large arrays to the stream as raw blobs that precede the pickle """
+    def __init__(self, file, stream):
+        super(_StreamPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.stream = stream
+
+    def persistent_id(self, obj):
+        array = _as_array(obj)
+        if array is None:
+            return None
+        kind, array = array
+        position = self.stream.tell()
+        offset = _align(position + 9)
+        self.stream.write(b'A' + struct.pack('<Q', array.nbytes) + b'\0' * (offset - position - 9))
+        self.stream.write(_bytes_view(array))
+        return kind, array.dtype.str, array.shape, offset
+
+
+class _StreamUnpickler(pickle.Unpickler):
+    def __init__(self, file, path):
+        super(_StreamUnpickler, self).__init__(file)
+        self.path = path
+
+    def persistent_load(self, pid):
+        kind, dtype, shape, offset = pid
+        if kind == 'torch':
+            import torch
+            return torch.from_numpy(np.memmap(self.path, dtype=np.dtype(dtype), mode='c', offset=offset, shape=shape))
+        return np.memmap(self.path, dtype=np.dtype(dtype), mode='r', offset=offset, shape=shape)
+
+
+def _write_chunk(stream, chunk):
+    buffer = io.BytesIO()
+    _StreamPickler(buffer, stream).dump(chunk)
+    stream.write(b'P' + struct.pack('<Q', buffer.tell()))
+    stream.write(buffer.getbuffer())
+
+
+def _read_chunks(f, path):
+    """ Yields chunks from the stream file f, which is positioned after the magic """
+    while True:
+        tag = f.read(1)
+        if not tag:
+            return
+        size, = struct.unpack('<Q', f.read(8))
+        if tag == b'A':
+            offset = _align(f.tell())
+            if hasattr(os, 'posix_fadvise'):
+                # Ask the kernel to start reading array data, that will be memory-mapped by the consumer
+                os.posix_fadvise(f.fileno(), offset, size, os.POSIX_FADV_WILLNEED)
+            f.seek(offset + size)
+        elif tag == b'P':
+            yield _StreamUnpickler(io.BytesIO(f.read(size)), path).load()
+        else:
+            raise pickle.UnpicklingError("Invalid record in stream %s" % path)
+
+
+def _put(queue, item, quit_event):
+    while not quit_event.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return
+        except Full:
+            pass
+
+
+def _read_ahead(f, path, queue, quit_event):
+    try:
+        for chunk in _read_chunks(f, path):
+            _put(queue, (True, chunk), quit_event)
+            if quit_event.is_set():
+                return
+        _put(queue, (False, None), quit_event)
+    except Exception as e:
+        _put(queue, (None, e), quit_event)
+    finally:
+        f.close()
+
+
+class cache_stream(cache):
+    """ Caches chunks yielded by a generator function.
+
+    On the first call with given arguments, chunks yielded by the generator are passed through and at the same time
+    appended to a stream file in the cache. The entry is committed only if the generator is consumed to the end.
+    Subsequent calls replay the chunks from the file lazily, without calling the function. A background thread reads
+    and unpickles up to :attr:`read_ahead` chunks in advance. Large NumPy arrays and torch tensors in chunks are stored
+    as raw data and are returned as memory-mapped arrays, read-only for NumPy and copy-on-write for torch.
+
+    Keys, cache root, eviction and statistics work the same way as for :class:`dlutils.cache`.
+
+    Note:
+
+        While a stream is recorded, the entry is locked, so other processes that call the function with the same
+        arguments at the same time just compute the chunks without recording them.
+
+    Args:
+        function (function): generator function to be called.
+        root (str, optional): Directory where cache entries are stored. Defaults to ``DLUTILS_CACHE_DIR`` environment
+            variable or '.cache'.
+        max_bytes (int, optional): Size budget of the cache root in bytes. Defaults to None (no limit).
+        max_age (float, optional): Entries that were not accessed for more than this number of seconds are evicted.
+            Defaults to None (no limit).
+        hash_source (bool, optional): Include hash of the function source into the key. Defaults to False.
+        read_ahead (int, optional): Maximum number of chunks to read in advance when replaying. Defaults to 4.
+
+    Example:
+
+        ::
+
+            @dlutils.cache_stream
+            def extract_features(path):
+                for batch in read_batches(path):
+                    yield model(batch)
+
+            for features in extract_features('data/train'):
+                ...
+
+    """
+    def __init__(self, function, root=None, max_bytes=None, max_age=None, hash_source=False, read_ahead=4):
+        super(cache_stream, self).__init__(function, root=root, max_bytes=max_bytes, max_age=max_age,
+                                           hash_source=hash_source)
+        self.read_ahead = read_ahead
+
+    def __call__(self, *args, **kwargs):
+        stem = self.store.entry_stem(self.key(*args, **kwargs), self.pickle_name)
+        path = self.store.full_path(stem, '.stream')
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            f = None
+        if f is not None:
+            if f.read(len(_STREAM_MAGIC)) == _STREAM_MAGIC:
+                return self._replay(stem, f, path)
+            f.close()
+            self.stats.add(errors=1)
+            logging.getLogger(__name__).warning("Invalid cache stream %s, recomputing" % path)
+        return self._record(stem, path, args, kwargs)
+
+    def _record(self, stem, path, args, kwargs):
+        self.stats.add(misses=1)
+        iterator = iter(self.function(*args, **kwargs))
+        temp = path + temp_suffix()
+        compute_time = 0.0
+        f = None
+        lock = self.store.lock(stem)
+        if not lock.acquire(blocking=False):
+            lock = None
+        try:
+            if lock is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                f = open(temp, 'wb')
+                f.write(_STREAM_MAGIC)
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    compute_time += time.perf_counter() - start
+                    break
+                compute_time += time.perf_counter() - start
+                if f is not None:
+                    try:
+                        _write_chunk(f, chunk)
+                    except Exception as e:
+                        logging.getLogger(__name__).warning("Can't record stream %s. %s: %s" % (
+                            path, e.__class__.__name__, e))
+                        f.close()
+                        os.remove(temp)
+                        f = None
+                yield chunk
+            self.stats.add(compute_time=compute_time)
+            if f is not None:
+                f.close()
+                os.replace(temp, path)
+                f = None
+                size = self.store.entry_size(stem)
+                self.stats.add(bytes_written=size, raw_bytes=size, stored_bytes=size)
+                self.store.index.add(stem, size, compute_time)
+                self.store.evict(self.max_bytes, self.max_age)
+        finally:
+            if f is not None:
+                # Generator was not consumed to the end, or failed
+                f.close()
+                os.remove(temp)
+            if lock is not None:
+                lock.release()
+
+    def _replay(self, stem, f, path):
+        compute_time = self.store.index.touch(stem)
+        queue = Queue(max(1, self.read_ahead))
+        quit_event = threading.Event()
+        self.stats.add(hits=1, bytes_read=os.fstat(f.fileno()).st_size)
+        thread = threading.Thread(target=_read_ahead, args=(f, path, queue, quit_event))
+        thread.daemon = True
+        thread.start()
+        load_time = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                status, chunk = queue.get()
+                load_time += time.perf_counter() - start
+                if status is None:
+                    self.stats.add(errors=1)
+                    raise chunk
+                if not status:
+                    break
+                yield chunk
+        finally:
+            quit_event.set()
+            self.stats.add(load_time=load_time,
+                           time_saved=compute_time - load_time if compute_time is not None else 0.0)
+
+
+class SampleCache(object):
+    """ Persistent cache of per-sample outputs, keyed by sample index.
+
+    Outputs are stored in fixed-stride memory-mapped `.npy` files, one row per sample, plus a flag array that marks
+    which rows are filled. Each output must be a NumPy array, or a tuple of NumPy arrays, of the same shape and dtype
+    for all samples. Shapes and dtypes are taken from the first stored output. Cached outputs are returned as
+    read-only views of the mapped files, so copy them before modifying in place.
+
+    It is meant to be used with :func:`dlutils.batch_provider` to avoid repeating deterministic per-sample work, like
+    decoding and resizing, on every epoch. Several threads and processes can fill the same cache at once.
+
+    Note:
+
+        Samples are identified only by index, which must be a stable id of the sample, like its index in the original
+        list, not its position in a shuffled one. If the dataset changes, the cache files must be deleted.
+
+    Args:
+        path (str): Path prefix of cache files.
+        size (int): Number of samples.
+
+    Example:
+
+        ::
+
+            def decode(filename):
+                return np.asarray(Image.open(filename).resize((256, 256)))
+
+            samples = dlutils.SampleCache('.cache/train_256', len(filenames))
+            image = samples.get(index, lambda: decode(filenames[index]))
+
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.fields = None
+        self.valid = None
+        self.is_tuple = None
+        self.hits = 0
+        self.misses = 0
+        self._open()
+
+    def _open(self):
+        try:
+            with open(self.path + '.meta', 'rb') as f:
+                is_tuple, count = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        fields = [np.load(self.path + '.%d.npy' % i, mmap_mode='r+') for i in range(count)]
+        valid = np.load(self.path + '.valid.npy', mmap_mode='r+')
+        if valid.shape[0] != self.size:
+            raise ValueError("Sample cache %s has %d samples, but %d expected" % (self.path, valid.shape[0], self.size))
+        self.is_tuple = is_tuple
+        self.fields = fields
+        self.valid = valid
+        return True
+
+    def _create(self, arrays, is_tuple):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with _FileLock(self.path + '.lock'):
+            # Some other process could have created it while we were waiting for the lock
+            if self._open():
+                return
+            layouts = [(a.dtype, a.shape) for a in arrays] + [(np.uint8, ())]
+            names = ['%d' % i for i in range(len(arrays))] + ['valid']
+            for (dtype, shape), name in zip(layouts, names):
+                path = self.path + '.%s.npy' % name
+                m = np.lib.format.open_memmap(path + temp_suffix(), mode='w+', dtype=dtype, shape=(self.size,) + shape)
+                temp = m.filename
+                del m
+                os.replace(temp, path)
+            # Meta is written last, it marks that all other files are complete
+            with open(self.path + '.meta' + temp_suffix(), 'wb') as f:
+                pickle.dump((is_tuple, len(arrays)), f)
+            os.replace(f.name, self.path + '.meta')
+            self._open()
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, index):
+        return self.valid is not None and bool(self.valid[index])
+
+    def __getitem__(self, index):
+        if index not in self:
+            raise KeyError(index)
+        views = []
+        for field in self.fields:
+            view = field[index]
+            if isinstance(view, np.ndarray):
+                view = view.view(np.ndarray)
+                view.flags.writeable = False
+            views.append(view)
+        return tuple(views) if self.is_tuple else views[0]
+
+    def __setitem__(self, index, sample):
+        is_tuple = isinstance(sample, (tuple, list))
+        arrays = [np.asarray(x) for x in (sample if is_tuple else [sample])]
+        if self.fields is None:
+            with self.lock:
+                if self.fields is None:
+                    self._create(arrays, is_tuple)
+        if is_tuple != self.is_tuple or len(arrays) != len(self.fields):
+            raise ValueError("Sample structure does not match the one stored in %s" % self.path)
+        for field, array in zip(self.fields, arrays):
+            if field.dtype != array.dtype or field.shape[1:] != array.shape:
+                raise ValueError("Sample of shape %s and dtype %s does not match shape %s and dtype %s stored in %s" % (
+                    array.shape, array.dtype, field.shape[1:], field.dtype, self.path))
+        for field, array in zip(self.fields, arrays):
+            field[index] = array
+        # Flag is set after the data, so that concurrent readers never see incomplete sample
+        self.valid[index] = 1
+
+    def get(self, index, compute):
+        """ Returns sample with given index, calling :attr:`compute` and storing its result if it is not cached yet.
+
+        Args:
+            index (int): Index of the sample.
+            compute (Callable[[], Any]): Function that computes the sample.
+
+        Returns:
+            Cached sample, or the result of :attr:`compute`.
+        """
+        if index in self:
+            self.hits += 1
+            return self[index]
+        self.misses += 1
+        sample = compute()
+        self[index] = sample
+        return sample
+
+    def flush(self):
+        """ Writes modified pages to disk. Not needed for other processes to see the data. """
+        if self.fields is not None:
+            for field in self.fields:
+                field.flush()
+            self.valid.flush()
+
 
 if __name__ == '__main__':
 
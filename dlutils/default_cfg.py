@@ -25,6 +25,21 @@ _C.TRAIN.SNAPSHOT_FREQ = 100
 
 _C.TRAIN.REPORT_FREQ = 30
 
+# Multi-node options of dlutils.run, shared by all nodes. Command line and environment variables take precedence.
+# Zero or empty values are not set.
+_C.DISTRIBUTED = CN()
+_C.DISTRIBUTED.NNODES = 0
+_C.DISTRIBUTED.MASTER_ADDR = ''
+_C.DISTRIBUTED.MASTER_PORT = 0
+
+# Profiling options of dlutils.run, see dlutils.pytorch.launcher.Profiler. Command line takes precedence.
+# MODE is 'cprofile' or 'torch', zero or empty values are not set.
+_C.PROFILE = CN()
+_C.PROFILE.MODE = ''
+_C.PROFILE.START = 0
+_C.PROFILE.STEPS = 0
+_C.PROFILE.RANKS = []
+
 
 def get_default_cfg():
     return _C.clone()
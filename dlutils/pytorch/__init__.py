@@ -13,10 +13,16 @@
 # limitations under the License.
 # ==============================================================================
 
-from dlutils.pytorch.jacobian import jacobian
-from dlutils.pytorch.count_parameters import count_parameters
-from dlutils.pytorch.launcher import run
-from dlutils.pytorch import lr_eq_adam
-from dlutils.pytorch import lr_eq_sgd
-from dlutils.pytorch import lr_eq
-from dlutils.pytorch.checkpointer import Checkpointer
+from dlutils import _lazy
+
+_lazy.install(__name__, {
+    'jacobian': ('dlutils.pytorch.jacobian', 'jacobian'),
+    'count_parameters': ('dlutils.pytorch.count_parameters', 'count_parameters'),
+    'run': ('dlutils.pytorch.launcher', 'run'),
+    'Checkpointer': ('dlutils.pytorch.checkpointer', 'Checkpointer'),
+    'lr_eq_adam': ('dlutils.pytorch.lr_eq_adam', None),
+    'lr_eq_sgd': ('dlutils.pytorch.lr_eq_sgd', None),
+    'lr_eq': ('dlutils.pytorch.lr_eq', None),
+    'launcher': ('dlutils.pytorch.launcher', None),
+    'checkpointer': ('dlutils.pytorch.checkpointer', None),
+})
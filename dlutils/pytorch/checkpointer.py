@@ -14,13 +14,27 @@
 # ==============================================================================
 
 import os
+import re
+import glob
+import json
+import copy
+import time
+import threading
+import collections
+import concurrent.futures
 from torch import nn
 import torch
+import torch.distributed as dist
 from dlutils import async_func
+from dlutils.pytorch.tensor_store import TensorStore, is_manifest
 import yacs.config
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 
-__all__ = ['Checkpointer']
+__all__ = ['Checkpointer', 'CheckpointStats', 'CheckpointRecord']
 
 
 def get_model_dict(x):
@@ -39,17 +53,536 @@ def load_model(x, state_dict, strict):
         x.load_state_dict(state_dict, strict=strict)
 
 
+class CheckpointRecord(object):
+    """ Timings of a single save or load of a checkpoint.
+
+    Attributes:
+        kind (str): 'save' or 'load'.
+        name (str): Name of the checkpoint, or path of the loaded file.
+        status (str): 'pending', 'written', 'dropped' by the queue policy, 'failed', or 'loaded'.
+        stall (float): Time in seconds :meth:`Checkpointer.save` blocked the training loop: collecting state dicts,
+            waiting for room in the queue and taking a snapshot.
+        queue_time (float): Time in seconds the save waited in the queue before writing started.
+        write_time (float): Time in seconds spent on serializing and writing the checkpoint in background, including
+            waiting for parts of other ranks in sharded mode.
+        bytes_written (int): Bytes written to disk.
+        tensor_bytes (int): Total size of tensors in the saved checkpoint, or of tensors restored from the loaded one.
+            Models and auxiliary objects that were not selected for loading are not counted.
+        load_time (float): Time in seconds spent on reading the checkpoint. If it was memory-mapped, that is only the
+            time to map it, and the tensors are read from disk during restore.
+        restore_time (float): Time in seconds spent in `load_state_dict` of models and auxiliary objects.
+        mmap (bool): Whether the loaded checkpoint was memory-mapped.
+    """
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.status = 'pending' if kind == 'save' else 'loaded'
+        self.stall = 0.0
+        self.queue_time = 0.0
+        self.write_time = 0.0
+        self.bytes_written = 0
+        self.tensor_bytes = 0
+        self.load_time = 0.0
+        self.restore_time = 0.0
+        self.mmap = False
+
+    @property
+    def read_time(self):
+        """ Time in seconds spent on reading tensors of the loaded checkpoint. With memory mapping, they are read while
+        restoring.
+        """
+        return self.load_time + self.restore_time if self.mmap else self.load_time
+
+    @property
+    def throughput(self):
+        """ Bytes per second written by save, or restored tensor bytes per second read by load. """
+        if self.kind == 'save':
+            return self.bytes_written / self.write_time if self.write_time > 0 else 0.0
+        return self.tensor_bytes / self.read_time if self.read_time > 0 else 0.0
+
+    def __str__(self):
+        if self.kind == 'save':
+            return "save %s (%s), stall: %.3fs, queued: %.3fs, write: %.3fs, written: %.1fMB, %.1fMB/s" % (
+                self.name, self.status, self.stall, self.queue_time, self.write_time, self.bytes_written / 1024 ** 2,
+                self.throughput / 1024 ** 2)
+        return "load %s, %s: %.3fs, restore: %.3fs, tensors: %.1fMB, %.1fMB/s" % (
+            self.name, 'map' if self.mmap else 'load', self.load_time, self.restore_time, self.tensor_bytes / 1024 ** 2,
+            self.throughput / 1024 ** 2)
+
+
+class CheckpointStats(object):
+    """ Statistics of saves and loads of a :class:`Checkpointer`.
+
+    Attributes:
+        records (collections.deque): :class:`CheckpointRecord` of the most recent saves and loads, oldest first.
+        saves (int): Number of written checkpoints.
+        dropped (int): Number of saves dropped by the queue policy.
+        failed (int): Number of saves that raised an exception.
+        loads (int): Number of loaded checkpoints.
+        stall_time (float): Total time in seconds the training loop was blocked by saves.
+        write_time (float): Total time in seconds spent on writing checkpoints in background.
+        bytes_written (int): Total number of bytes written.
+        load_time (float): Total time in seconds spent on reading tensors of loaded checkpoints, see
+            :attr:`CheckpointRecord.read_time`.
+        bytes_loaded (int): Total size of restored tensors.
+    """
+    def __init__(self, max_records=1000):
+        self.lock = threading.Lock()
+        self.records = collections.deque(maxlen=max_records)
+        self.saves = 0
+        self.dropped = 0
+        self.failed = 0
+        self.loads = 0
+        self.stall_time = 0.0
+        self.write_time = 0.0
+        self.bytes_written = 0
+        self.load_time = 0.0
+        self.bytes_loaded = 0
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def finish(self, record):
+        """ Adds finished save or load to totals """
+        with self.lock:
+            if record.kind == 'load':
+                self.loads += 1
+                self.load_time += record.read_time
+                self.bytes_loaded += record.tensor_bytes
+                return
+            self.stall_time += record.stall
+            if record.status == 'written':
+                self.saves += 1
+                self.write_time += record.write_time
+                self.bytes_written += record.bytes_written
+            elif record.status == 'dropped':
+                self.dropped += 1
+            else:
+                self.failed += 1
+
+    def last(self, kind='save'):
+        """ Returns the most recent record of given kind, or None """
+        with self.lock:
+            for record in reversed(self.records):
+                if record.kind == kind:
+                    return record
+        return None
+
+    @property
+    def write_throughput(self):
+        """ Average write speed of checkpoints in bytes per second. """
+        return self.bytes_written / self.write_time if self.write_time > 0 else 0.0
+
+    @property
+    def read_throughput(self):
+        """ Average speed of loading tensors in bytes per second. """
+        return self.bytes_loaded / self.load_time if self.load_time > 0 else 0.0
+
+    def __str__(self):
+        return "saves: %d, dropped: %d, failed: %d, stall: %.3fs, write: %.3fs, written: %.1fMB, %.1fMB/s, " \
+               "loads: %d, load: %.3fs, loaded: %.1fMB, %.1fMB/s" % (
+                self.saves, self.dropped, self.failed, self.stall_time, self.write_time, self.bytes_written / 1024 ** 2,
+                self.write_throughput / 1024 ** 2, self.loads, self.load_time, self.bytes_loaded / 1024 ** 2,
+                self.read_throughput / 1024 ** 2)
+
+
+def _tensor_bytes(x):
+    if isinstance(x, torch.Tensor):
+        return x.numel() * x.element_size()
+    if isinstance(x, dict):
+        return sum(_tensor_bytes(v) for v in x.values())
+    if type(x) in (list, tuple):
+        return sum(_tensor_bytes(v) for v in x)
+    return 0
+
+
+def _restore(item, state):
+    """ Loads state into auxiliary object and returns size of its tensors """
+    item.load_state_dict(state)
+    return _tensor_bytes(state)
+
+
+# Placeholder of a tensor that is stored in another part of a sharded checkpoint
+_SHARD_KEY = '_dlutils_shard'
+
+
+class _Sharder(object):
+    """ Splits tensors of data between ranks, balancing their size. Ranks have the same state, so they all get the same
+    split.
+    """
+    def __init__(self, world_size):
+        self.parts = [dict() for _ in range(world_size)]
+        self.sizes = [0] * world_size
+        self.count = 0
+
+    def split(self, x):
+        """ Returns skeleton of x, where tensors are replaced by placeholders """
+        if isinstance(x, torch.Tensor):
+            rank = self.sizes.index(min(self.sizes))
+            self.parts[rank][self.count] = x
+            self.sizes[rank] += _tensor_bytes(x)
+            self.count += 1
+            return {_SHARD_KEY: self.count - 1}
+        if isinstance(x, dict):
+            y = x.__class__()
+            for k, v in x.items():
+                y[k] = self.split(v)
+            if hasattr(x, '_metadata'):
+                y._metadata = x._metadata
+            return y
+        if type(x) in (list, tuple):
+            return type(x)(self.split(v) for v in x)
+        return x
+
+
+def _join(x, tensors):
+    """ Replaces placeholders in skeleton with tensors """
+    if isinstance(x, dict):
+        if len(x) == 1 and _SHARD_KEY in x:
+            return tensors[x[_SHARD_KEY]]
+        y = x.__class__()
+        for k, v in x.items():
+            y[k] = _join(v, tensors)
+        if hasattr(x, '_metadata'):
+            y._metadata = x._metadata
+        return y
+    if type(x) in (list, tuple):
+        return type(x)(_join(v, tensors) for v in x)
+    return x
+
+
+def _part_file(save_file, token, rank):
+    base, ext = os.path.splitext(save_file)
+    return "%s.%s.part%d%s" % (base, token, rank, ext)
+
+
+def _remove_parts(save_file, before=None):
+    """ Removes parts of older saves of sharded checkpoint. Parts of newer saves may already be written by other ranks,
+    so only tokens that are less than `before` are removed. Without `before`, all parts are removed.
+    """
+    base, ext = os.path.splitext(save_file)
+    pattern = re.compile(re.escape(os.path.basename(base)) + r'\.([0-9a-f]{16})\.part\d+' + re.escape(ext) + '$')
+    for path in glob.glob("%s.*.part*%s" % (glob.escape(base), ext)):
+        match = pattern.match(os.path.basename(path))
+        if match is not None and (before is None or match.group(1) < before):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class _SnapshotBuffers(object):
+    """ Preallocated CPU tensors that state is copied into. Reused between saves, tensors are keyed by their path in the
+    saved data.
+    """
+    def __init__(self):
+        self.tensors = dict()
+        self.has_cuda = False
+
+    def copy(self, x, path=()):
+        if isinstance(x, torch.Tensor):
+            return self._copy_tensor(x, path)
+        if isinstance(x, dict):
+            y = x.__class__()
+            for k, v in x.items():
+                y[k] = self.copy(v, path + (k,))
+            if hasattr(x, '_metadata'):
+                # state_dict keeps versions of modules there, which are needed by load_state_dict
+                y._metadata = copy.deepcopy(x._metadata)
+            return y
+        if type(x) in (list, tuple):
+            return type(x)(self.copy(v, path + (i,)) for i, v in enumerate(x))
+        return copy.deepcopy(x)
+
+    def _copy_tensor(self, x, path):
+        x = x.detach()
+        if x.layout != torch.strided:
+            return x.clone().cpu()
+        buffer = self.tensors.get(path)
+        if buffer is None or buffer.shape != x.shape or buffer.dtype != x.dtype:
+            # Pinned memory allows copying from GPU asynchronously
+            buffer = torch.empty(x.shape, dtype=x.dtype, pin_memory=x.is_cuda)
+            self.tensors[path] = buffer
+        buffer.copy_(x, non_blocking=x.is_cuda)
+        self.has_cuda = self.has_cuda or x.is_cuda
+        return buffer
+
+    def snapshot(self, data):
+        self.has_cuda = False
+        data = self.copy(data)
+        if self.has_cuda:
+            torch.cuda.synchronize()
+        return data
+
+
 class Checkpointer(object):
-    def __init__(self, output_dir, models, auxiliary=None, logger=None, save=True):
+    """ Saves and restores state of models and auxiliary objects (optimizers, schedulers, trackers, etc.).
+
+    Checkpoints are written in background. Files are written to a temporary file first and then renamed, so
+    `last_checkpoint` always points to a complete file.
+
+    Args:
+        output_dir (Union[str, yacs.config.CfgNode]): Directory for checkpoints, or config with OUTPUT_DIR.
+        models (dict): Models to save, by name.
+        auxiliary (dict, optional): Other objects with `state_dict` and `load_state_dict` methods, by name.
+        logger (logging.Logger, optional): Logger.
+        save (bool, optional): If False, :meth:`save` does nothing. Defaults to True.
+        snapshot (bool, optional): Copy all tensors into preallocated CPU buffers on :meth:`save`, before returning.
+            Otherwise, the background thread saves tensors that training keeps updating in place, so the saved file
+            may mix weights from different steps. Two sets of buffers are kept, so that the next snapshot can be taken
+            while the previous one is being written. Defaults to False.
+        max_pending (int, optional): Maximum number of saves waiting in the queue, while another one is being written.
+            Saves are written one by one in order of :meth:`save` calls, so `last_checkpoint` always points to the
+            newest written checkpoint. With snapshot mode, ``max_pending + 1`` sets of buffers are kept. Defaults to 1.
+        policy (str, optional): What :meth:`save` does when the queue is full. 'block' waits until a queued save
+            starts writing. 'drop_oldest' cancels the oldest queued save. 'coalesce' cancels all queued saves, so only
+            the newest one is written. Defaults to 'block'.
+        format (str, optional): 'pth' writes every checkpoint as a single file with `torch.save`. 'store' writes
+            tensors into a content-addressed store in ``output_dir/blobs`` and a small ``<name>.ckpt`` manifest, so
+            tensors that did not change, like frozen weights, are written only once and are shared between
+            checkpoints. :meth:`load` reads both formats. Defaults to 'pth'.
+        compression (str, optional): Codec for 'store' format, one of 'zlib', 'lzma', 'bz2' or registered with
+            :func:`dlutils.register_codec`. Tensors are split into chunks that are compressed in parallel on all
+            cores, and decompressed in parallel on load. Useful when writing to a slow network filesystem. Compressed
+            tensors can not be memory-mapped. Defaults to None.
+        compression_level (int, optional): Compression level, passed to the codec.
+        distributed (str, optional): What to do when `torch.distributed` is initialized with several processes. All
+            ranks must call :meth:`save`, :meth:`wait` and :meth:`load` then, since they synchronize ranks.
+            'rank0' - only rank 0 writes checkpoints, :meth:`save` does nothing on other ranks, and :meth:`wait`
+            waits on all ranks until rank 0 has written its pending saves. 'sharded' - tensors are split between ranks,
+            and each rank writes its part in parallel, so save time does not grow with the number of ranks. Rank 0
+            also writes the rest of the state, and moves `last_checkpoint` only after parts of all ranks are written.
+            :meth:`load` reassembles the parts. Requires 'block' policy. Defaults to None, every process saves on its
+            own.
+        shard_timeout (float, optional): In 'sharded' mode, how long rank 0 waits for parts of other ranks, in seconds.
+            If some part does not appear in time, e.g. because a rank failed to write it or died, the save is marked
+            as failed, so that later saves are not stuck behind it. Defaults to 600.
+        keep_last (int, optional): Keep only this many most recent checkpoints.
+        keep_every (int, optional): Also keep every N-th checkpoint, counting saves from the first one.
+        keep_best (int, optional): Also keep this many best checkpoints by value of `metric`.
+        metric (str, optional): Name of keyword argument of :meth:`save` that is used by `keep_best`.
+        mode (str, optional): 'min' or 'max', whether lower or higher values of `metric` are better. Defaults to 'min'.
+
+    If any of `keep_last`, `keep_every`, `keep_best` is set, after each write the background thread removes
+    checkpoints that none of them keeps. Saved checkpoints are tracked in ``output_dir/checkpoints.json``, only those
+    are ever removed, and never the one `last_checkpoint` points to. With 'store' format, blobs that no manifest in
+    `output_dir` references anymore are removed too. By default, all checkpoints are kept.
+
+    Attributes:
+        stats (CheckpointStats): Timings of every save and load. Each save is also logged with its stall time, write
+            time, bytes written and throughput.
+
+    Example:
+
+        ::
+
+            checkpointer.save("model_%d" % epoch, epoch=epoch)
+            ...
+            record = checkpointer.stats.last('save')
+            print(record.stall, record.write_time, record.throughput)
+            print(checkpointer.stats)
+
+    """
+    def __init__(self, output_dir, models, auxiliary=None, logger=None, save=True, snapshot=False, max_pending=1,
+                 policy='block', format='pth', keep_last=None, keep_every=None, keep_best=None, metric=None,
+                 mode='min', compression=None, compression_level=None, distributed=None, shard_timeout=600):
+        if policy not in ('block', 'drop_oldest', 'coalesce'):
+            raise ValueError("Unknown policy: %s" % policy)
+        if format not in ('pth', 'store'):
+            raise ValueError("Unknown format: %s" % format)
+        if compression is not None and format != 'store':
+            raise ValueError("compression requires 'store' format")
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least one")
+        if keep_best is not None and metric is None:
+            raise ValueError("keep_best requires metric")
+        if mode not in ('min', 'max'):
+            raise ValueError("Unknown mode: %s" % mode)
+        if distributed not in (None, 'rank0', 'sharded'):
+            raise ValueError("Unknown distributed mode: %s" % distributed)
+        if distributed == 'sharded' and policy != 'block':
+            # Each rank would decide on its own which saves to drop, and rank 0 would wait for parts that never come
+            raise ValueError("'sharded' mode requires 'block' policy")
         self.models = models
         self.auxiliary = auxiliary
         self.output_dir = output_dir.OUTPUT_DIR if isinstance(output_dir, yacs.config.CfgNode) else output_dir
         self.logger = logger
         self._save = save
+        self.snapshot = snapshot
+        self.max_pending = max_pending
+        self.policy = policy
+        self.format = format
+        self._store = None
+        if format == 'store':
+            self._store = TensorStore(os.path.join(self.output_dir, 'blobs'), compression, compression_level)
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.keep_best = keep_best
+        self.metric = metric
+        self.mode = mode
+        self.distributed = distributed
+        self.shard_timeout = shard_timeout
+        self._buffers = Queue()
+        if snapshot:
+            for _ in range(max_pending + 1):
+                self._buffers.put(_SnapshotBuffers())
+        # Single thread, so that saves are written in order
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpointer')
+        self._pending = collections.deque()
+        self._pending_cv = threading.Condition()
+        self.stats = CheckpointStats()
+
+    @property
+    def pending_saves(self):
+        """ Number of saves that are queued or being written. """
+        with self._pending_cv:
+            return len(self._pending)
+
+    @property
+    def bytes_saved(self):
+        """ Total number of bytes written. """
+        return self.stats.bytes_written
+
+    @property
+    def save_time(self):
+        """ Total time in seconds spent on writing checkpoints in background. """
+        return self.stats.write_time
+
+    @property
+    def save_throughput(self):
+        """ Average write speed of checkpoints in bytes per second. """
+        return self.stats.write_throughput
+
+    def _queued(self):
+        return [call for call in self._pending if not call.future.running() and not call.done()]
+
+    def _make_room(self):
+        with self._pending_cv:
+            if self.policy == 'block':
+                while len(self._queued()) >= self.max_pending:
+                    self._pending_cv.wait()
+            else:
+                queued = self._queued()
+                drop = queued if self.policy == 'coalesce' else queued[:len(queued) - self.max_pending + 1]
+                for call in drop:
+                    if call.cancel():
+                        self.logger.warning("Dropped pending checkpoint save")
+
+    def _on_done(self, call, buffers, record):
+        if buffers is not None:
+            self._buffers.put(buffers)
+        if call.cancelled():
+            record.status = 'dropped'
+        elif record.status == 'pending':
+            record.status = 'failed'
+            e = call.exception()
+            if e is not None:
+                self.logger.error("Failed to save checkpoint", exc_info=(type(e), e, e.__traceback__))
+        self.stats.finish(record)
+        with self._pending_cv:
+            self._pending.remove(call)
+            self._pending_cv.notify_all()
+
+    def _world(self):
+        """ Returns rank and number of processes that save together """
+        if self.distributed is None or not dist.is_available() or not dist.is_initialized():
+            return 0, 1
+        return dist.get_rank(), dist.get_world_size()
+
+    def _write(self, data, save_file):
+        """ Returns number of bytes written, size of tensors that were stored and total size of tensors """
+        if self._store is not None:
+            # Snapshot buffers are not reused until the save is done, other tensors may be updated by training
+            return self._store.save(data, save_file, copy=not self.snapshot)
+        torch.save(data, save_file + '.tmp')
+        os.replace(save_file + '.tmp', save_file)
+        size = os.path.getsize(save_file)
+        return size, size, size
+
+    def _wait_for_parts(self, save_file, token, world_size):
+        parts = [_part_file(save_file, token, rank) for rank in range(1, world_size)]
+        start = time.time()
+        warned = False
+        while not all(os.path.exists(part) for part in parts):
+            elapsed = time.time() - start
+            if elapsed > self.shard_timeout or (not warned and elapsed > 60):
+                missing = [rank + 1 for rank, part in enumerate(parts) if not os.path.exists(part)]
+                if elapsed > self.shard_timeout:
+                    for part in [_part_file(save_file, token, 0)] + parts:
+                        try:
+                            os.remove(part)
+                        except FileNotFoundError:
+                            pass
+                    raise TimeoutError("Parts of checkpoint %s from ranks %s were not written in %.0fs" % (
+                        save_file, missing, self.shard_timeout))
+                self.logger.warning("Still waiting for parts of checkpoint %s from ranks %s" % (save_file, missing))
+                warned = True
+            time.sleep(0.05)
+
+    def _retain(self, save_file, value, token=None):
+        history_file = os.path.join(self.output_dir, "checkpoints.json")
+        try:
+            with open(history_file, "r") as f:
+                history = json.load(f)
+        except (IOError, ValueError):
+            history = []
+        index = max([entry["index"] for entry in history], default=-1) + 1
+        file_name = os.path.basename(save_file)
+        history = [entry for entry in history if entry["file"] != file_name]
+        history.append(dict(file=file_name, index=index, metric=value))
+
+        keep = set([file_name])
+        try:
+            with open(os.path.join(self.output_dir, "last_checkpoint"), "r") as f:
+                keep.add(os.path.basename(f.read().strip()))
+        except IOError:
+            pass
+        if self.keep_last is not None:
+            keep.update(entry["file"] for entry in history[max(len(history) - self.keep_last, 0):])
+        if self.keep_every is not None:
+            keep.update(entry["file"] for entry in history if entry["index"] % self.keep_every == 0)
+        if self.keep_best is not None:
+            rated = [entry for entry in history if entry["metric"] is not None]
+            rated.sort(key=lambda entry: entry["metric"], reverse=self.mode == 'max')
+            keep.update(entry["file"] for entry in rated[:self.keep_best])
+
+        removed = [entry["file"] for entry in history if entry["file"] not in keep]
+        history = [entry for entry in history if entry["file"] in keep]
+        with open(history_file + '.tmp', "w") as f:
+            json.dump(history, f, indent=1)
+        os.replace(history_file + '.tmp', history_file)
+
+        for name in removed:
+            _remove_parts(os.path.join(self.output_dir, name), before=token)
+            try:
+                os.remove(os.path.join(self.output_dir, name))
+                self.logger.info("Removed checkpoint %s" % name)
+            except FileNotFoundError:
+                pass
+        if removed and self._store is not None:
+            # Other ranks may be storing tensors of their next parts, while the manifests are not written yet
+            grace = 3600 if self.distributed == 'sharded' else 0
+            freed = self._store.collect(glob.glob(os.path.join(self.output_dir, "*.ckpt")), grace)
+            self.logger.info("Removed %.1f MB of unreferenced tensors" % (freed / 1024 ** 2))
+
+    def wait(self):
+        """ Waits until all pending saves are written. In distributed modes, also waits for other ranks. """
+        with self._pending_cv:
+            while self._pending:
+                self._pending_cv.wait()
+        if self._world()[1] > 1:
+            dist.barrier()
 
     def save(self, _name, **kwargs):
         if not self._save:
             return
+        rank, world_size = self._world()
+        if self.distributed == 'rank0' and rank != 0:
+            return
+        start = time.perf_counter()
+        record = CheckpointRecord('save', _name)
+        self.stats.add(record)
         data = dict()
         data["models"] = dict()
         data["auxiliary"] = dict()
@@ -66,16 +599,139 @@ class Checkpointer(object):
                 data["auxiliary"][name] = item.state_dict()
         data.update(kwargs)
 
-        @async_func
+        retain = self.keep_last is not None or self.keep_every is not None or self.keep_best is not None
+        value = None
+        if self.metric is not None and self.metric in kwargs:
+            value = float(kwargs[self.metric])
+
+        sharded = self.distributed == 'sharded' and world_size > 1
+        skeleton = None
+        token = None
+        if sharded:
+            # Token tells parts of this save from parts of older and newer saves with the same name, it grows with time
+            token = ["%016x" % int(time.time() * 1e9)]
+            dist.broadcast_object_list(token, src=0)
+            token = token[0]
+            sharder = _Sharder(world_size)
+            skeleton = sharder.split(data)
+            skeleton["_shards"] = dict(token=token, world_size=world_size)
+            # Only own part is snapshotted and written
+            data = sharder.parts[rank]
+
+        self._make_room()
+
+        buffers = None
+        if self.snapshot:
+            buffers = self._buffers.get()
+            try:
+                data = buffers.snapshot(data)
+            except BaseException:
+                self._buffers.put(buffers)
+                raise
+            if skeleton is not None:
+                skeleton = copy.deepcopy(skeleton)
+
         def save_data():
-            save_file = os.path.join(self.output_dir, "%s.pth" % _name)
-            self.logger.info("Saving checkpoint to %s" % save_file)
-            torch.save(data, save_file)
+            # This save left the queue, which wakes up a save that waits for room with the 'block' policy
+            with self._pending_cv:
+                self._pending_cv.notify_all()
+            save_file = os.path.join(self.output_dir, "%s.%s" % (_name, 'ckpt' if self._store is not None else 'pth'))
+            start = time.perf_counter()
+            record.queue_time = start - submitted
+            if sharded:
+                part_file = _part_file(save_file, token, rank)
+                self.logger.info("Saving part %d of checkpoint to %s" % (rank, part_file))
+                size, stored, total = self._write(data, part_file)
+                if rank != 0:
+                    record.write_time = time.perf_counter() - start
+                    record.bytes_written = size
+                    record.tensor_bytes = total
+                    record.status = 'written'
+                    self.logger.info("Saved part %d of checkpoint %s, %.1f MB written in %.2fs, %.1f MB/s, "
+                                     "stall %.3fs" % (rank, save_file, size / 1024 ** 2, record.write_time,
+                                                      record.throughput / 1024 ** 2, record.stall))
+                    return
+                # Checkpoint file is written only when all parts are there, so it never references missing parts
+                self._wait_for_parts(save_file, token, world_size)
+                size += self._write(skeleton, save_file)[0]
+                _remove_parts(save_file, before=token)
+            else:
+                self.logger.info("Saving checkpoint to %s" % save_file)
+                size, stored, total = self._write(data, save_file)
             self.tag_last_checkpoint(save_file)
+            record.write_time = time.perf_counter() - start
+            record.bytes_written = size
+            record.tensor_bytes = total
+            record.status = 'written'
+            message = "Saved checkpoint %s, %.1f MB written in %.2fs, %.1f MB/s, stall %.3fs" % (
+                save_file, size / 1024 ** 2, record.write_time, record.throughput / 1024 ** 2, record.stall)
+            if self._store is not None:
+                message += ", %.1f MB of %.1f MB of tensors changed" % (stored / 1024 ** 2, total / 1024 ** 2)
+                if self._store.compression is not None and stored > 0:
+                    message += ", compression ratio %.2f" % (stored / max(size, 1))
+            self.logger.info(message)
+            if retain:
+                self._retain(save_file, value, token)
+
+        record.stall = time.perf_counter() - start
+        submitted = time.perf_counter()
+        with self._pending_cv:
+            call = async_func(save_data, executor=self._executor)()
+            self._pending.append(call)
+        call.future.add_done_callback(lambda _: self._on_done(call, buffers, record))
+        return call
+
+    def _load_file(self, f, mmap):
+        checkpoint = self._load_single(f, mmap)
+        shards = checkpoint.pop("_shards", None)
+        if shards is not None:
+            tensors = dict()
+            for rank in range(shards["world_size"]):
+                tensors.update(self._load_single(_part_file(f, shards["token"], rank), mmap))
+            checkpoint = _join(checkpoint, tensors)
+        return checkpoint
+
+    def _load_single(self, f, mmap):
+        if is_manifest(f):
+            # Blobs are looked up next to the manifest, so that checkpoints can be loaded from other directories
+            return TensorStore(os.path.join(os.path.dirname(f), 'blobs')).load(f, mmap)
+        if mmap:
+            try:
+                # Storages are mapped from the file, so only bytes of tensors that are actually used get read
+                return torch.load(f, map_location=torch.device("cpu"), mmap=True)
+            except (TypeError, RuntimeError) as e:
+                # Old versions of torch do not support mmap, legacy (non zip) checkpoints can not be mapped
+                self.logger.warning("Can't memory-map checkpoint %s, loading it fully: %s" % (f, e))
+        return torch.load(f, map_location=torch.device("cpu"))
+
+    def load(self, ignore_last_checkpoint=False, file_name=None, strict=True, models=None, auxiliary=None,
+             mmap=False):
+        """ Loads checkpoint. By default, the one that `last_checkpoint` points to.
+
+        Args:
+            ignore_last_checkpoint (bool, optional): Do not load anything. Defaults to False.
+            file_name (str, optional): Checkpoint file to load instead of the last one.
+            strict (bool, optional): Passed to `load_state_dict` of models. Defaults to True.
+            models (list, optional): Names of models to load. Defaults to None, which loads all models.
+            auxiliary (list, optional): Names of auxiliary objects to load. Defaults to None, which loads all of them.
+            mmap (bool, optional): Memory-map tensor storage instead of reading the whole file, so that only entries
+                that are loaded are read from disk. Defaults to False.
+
+        Returns:
+            dict: Extra values that were passed to :meth:`save`.
+
+        Example:
+
+            ::
 
-        return save_data()
+                # Reads only generator weights from the training checkpoint
+                checkpointer = Checkpointer(cfg, dict(generator=generator), logger=logger)
+                checkpointer.load(mmap=True)
 
-    def load(self, ignore_last_checkpoint=False, file_name=None, strict=True):
+        """
+        if self._world()[1] > 1:
+            # Checkpoint that rank 0 is writing may be the last one
+            self.wait()
         save_file = os.path.join(self.output_dir, "last_checkpoint")
         f = None
         try:
@@ -97,13 +753,21 @@ class Checkpointer(object):
             return
 
         self.logger.info("Loading checkpoint from {}".format(f))
-        checkpoint = torch.load(f, map_location=torch.device("cpu"))
+        start = time.perf_counter()
+        checkpoint = self._load_file(f, mmap)
+        record = CheckpointRecord('load', f)
+        record.load_time = time.perf_counter() - start
+        record.mmap = mmap
+        start = time.perf_counter()
         for name, model in self.models.items():
+            if models is not None and name not in models:
+                continue
             if name in checkpoint["models"]:
                 try:
                     model_dict = checkpoint["models"].pop(name)
                     if model_dict is not None:
                         load_model(self.models[name], model_dict, strict)
+                        record.tensor_bytes += _tensor_bytes(model_dict)
                     else:
                         self.logger.warning("State dict for model \"%s\" is None " % name)
                 except RuntimeError as e:
@@ -115,20 +779,32 @@ class Checkpointer(object):
         if "auxiliary" in checkpoint and self.auxiliary:
             self.logger.info("Loading auxiliary from {}".format(f))
             for name, item in self.auxiliary.items():
+                if auxiliary is not None and name not in auxiliary:
+                    continue
                 try:
                     if name in checkpoint["auxiliary"]:
-                        self.auxiliary[name].load_state_dict(checkpoint["auxiliary"].pop(name))
+                        record.tensor_bytes += _restore(self.auxiliary[name], checkpoint["auxiliary"].pop(name))
                     if "optimizers" in checkpoint and name in checkpoint["optimizers"]:
-                        self.auxiliary[name].load_state_dict(checkpoint["optimizers"].pop(name))
+                        record.tensor_bytes += _restore(self.auxiliary[name], checkpoint["optimizers"].pop(name))
                     if name in checkpoint:
-                        self.auxiliary[name].load_state_dict(checkpoint.pop(name))
+                        record.tensor_bytes += _restore(self.auxiliary[name], checkpoint.pop(name))
                 except (IndexError, ValueError):
                     self.logger.warning('%s\nFailed to load: %s\n%s' % ('!' * 160, name, '!' * 160))
             checkpoint.pop('auxiliary')
 
+        record.restore_time = time.perf_counter() - start
+        self.stats.add(record)
+        self.stats.finish(record)
+        if mmap:
+            self.logger.info("Mapped checkpoint in %.2fs, restored %.1f MB of tensors in %.2fs, %.1f MB/s" % (
+                record.load_time, record.tensor_bytes / 1024 ** 2, record.restore_time, record.throughput / 1024 ** 2))
+        else:
+            self.logger.info("Loaded checkpoint in %.2fs, restored %.1f MB of tensors in %.2fs, %.1f MB/s" % (
+                record.load_time, record.tensor_bytes / 1024 ** 2, record.restore_time, record.throughput / 1024 ** 2))
         return checkpoint
 
     def tag_last_checkpoint(self, last_filename):
         save_file = os.path.join(self.output_dir, "last_checkpoint")
-        with open(save_file, "w") as f:
+        with open(save_file + '.tmp', "w") as f:
             f.write(last_filename)
+        os.replace(save_file + '.tmp', save_file)
@@ -14,7 +14,12 @@
 # ==============================================================================
 
 import os
+import io
 import sys
+import cProfile
+import pstats
+import glob
+import socket
 import argparse
 import logging
 import torch
@@ -23,28 +28,230 @@ from torch import distributed
 import inspect
 
 
-__all__ = ['run']
+__all__ = ['run', 'Profiler']
 
 
-def setup(rank, world_size):
-    os.environ['MASTER_ADDR'] = 'localhost'
-    os.environ['MASTER_PORT'] = '12355'
-    distributed.init_process_group("nccl", rank=rank, world_size=world_size)
+def setup(rank, world_size, backend="nccl"):
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '12355')
+    distributed.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def _option(value, env, cfg, key, default):
+    """ Value of a launch option, from command line, environment, config or argument of :func:`run`, in that order """
+    if value is not None:
+        return value
+    if env is not None and env in os.environ:
+        return os.environ[env]
+    if cfg is not None and key in cfg and cfg[key]:
+        return cfg[key]
+    return default
+
+
+class Profiler(object):
+    """ Profiles a window of training steps with `cProfile` or `torch.profiler`. Created by :func:`run`.
+
+    `fn` that has `profiler` argument must call :meth:`step` after each training step. Then steps from `start` to
+    ``start + steps`` are profiled. Otherwise, the whole `fn` is profiled. On ranks that are not profiled, and if
+    profiling is not enabled, :meth:`step` does nothing.
+
+    'cprofile' writes ``profile_rank<rank>.pstats`` to the output directory, which can be read with `pstats` or
+    `snakeviz`, and logs functions with the largest cumulative time. 'torch' writes ``profile_rank<rank>.json``,
+    a Chrome trace for ``chrome://tracing`` or Perfetto, and logs operators with the largest total time.
+
+    Args:
+        mode (str): 'cprofile', 'torch', or None to disable profiling.
+        output_dir (str): Directory for results.
+        rank (int): Rank of the process, used in file names.
+        logger (logging.Logger): Logger.
+        start (int, optional): Number of steps to skip. Defaults to 0.
+        steps (int, optional): Number of steps to profile. Defaults to None, until the end.
+    """
+    def __init__(self, mode, output_dir, rank, logger, start=0, steps=None):
+        if mode not in (None, 'cprofile', 'torch'):
+            raise ValueError("Unknown profiler: %s" % mode)
+        self.mode = mode
+        self.output_dir = output_dir
+        self.rank = rank
+        self.logger = logger
+        self.start = start
+        self.steps = steps
+        self.step_count = 0
+        self._profile = None
+        self._done = False
+
+    @property
+    def enabled(self):
+        return self.mode is not None
+
+    @property
+    def active(self):
+        """ True while steps are being profiled """
+        return self._profile is not None
+
+    def _begin(self):
+        if not self.enabled or self._done or self._profile is not None:
+            return
+        self.logger.info("Profiling with %s from step %d" % (self.mode, self.step_count))
+        if self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profile = torch.profiler.profile(activities=activities, record_shapes=True)
+            self._profile.start()
+
+    def _end(self):
+        if self._profile is None:
+            return
+        profile = self._profile
+        self._profile = None
+        self._done = True
+        if self.mode == 'cprofile':
+            profile.disable()
+            path = os.path.join(self.output_dir, 'profile_rank%d.pstats' % self.rank)
+            profile.dump_stats(path)
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(20)
+            report = stream.getvalue()
+        else:
+            profile.stop()
+            path = os.path.join(self.output_dir, 'profile_rank%d.json' % self.rank)
+            profile.export_chrome_trace(path)
+            report = profile.key_averages().table(sort_by='self_cpu_time_total', row_limit=20)
+        self.logger.info("Profiled until step %d, wrote %s\n%s" % (self.step_count, path, report))
+
+    def begin(self):
+        """ Called before `fn` starts """
+        if self.start == 0:
+            self._begin()
+
+    def step(self):
+        """ Marks the end of a training step """
+        if not self.enabled:
+            return
+        self.step_count += 1
+        if self.step_count == self.start:
+            self._begin()
+        elif self.steps is not None and self.step_count == self.start + self.steps:
+            self._end()
+
+    def end(self):
+        """ Called after `fn` returns, writes results if the window was not finished """
+        self._end()
+
+
+def _load_config(defaults, args):
+    cfg = defaults.clone()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    return cfg
 
 
 def cleanup():
     distributed.destroy_process_group()
 
 
-def _run(rank, world_size, fn, defaults, write_log, no_cuda, args):
-    if world_size > 1:
-        setup(rank, world_size)
+def _available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    import multiprocessing
+    return list(range(multiprocessing.cpu_count()))
+
+
+def _parse_cpulist(text):
+    """ Parses cpu list of sysfs, e.g. '0-3,8-11' """
+    cores = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cores += range(int(first), int(last) + 1)
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def _numa_nodes():
+    """ Returns list of available cores of each NUMA node. One node with all available cores, if topology is not known.
+    """
+    available = _available_cores()
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                       key=lambda path: int(os.path.basename(os.path.dirname(path))[4:])):
+        try:
+            with open(path, 'r') as f:
+                cores = sorted(set(_parse_cpulist(f.read())).intersection(available))
+        except (IOError, ValueError):
+            continue
+        if cores:
+            nodes.append(cores)
+    return nodes or [available]
+
+
+def _plan_affinity(world_size, data_workers=0):
+    """ Assigns disjoint sets of cores to ranks, so that each rank stays within one NUMA node if possible.
+
+    Ranks are spread over NUMA nodes in contiguous blocks, and cores of each node are split evenly between its ranks. If
+    there are fewer ranks than nodes, each rank gets several whole nodes. Last `data_workers` cores of each rank are
+    left for data-loading workers, the rest is for compute threads.
+
+    Returns:
+        list: For each rank, dict with `numa_nodes`, `compute` and `workers` core lists.
+    """
+    nodes = _numa_nodes()
+    plan = []
+    for rank in range(world_size):
+        if world_size <= len(nodes):
+            numa_nodes = list(range(rank * len(nodes) // world_size, (rank + 1) * len(nodes) // world_size))
+            cores = sum((nodes[i] for i in numa_nodes), [])
+        else:
+            node = rank * len(nodes) // world_size
+            ranks = [r for r in range(world_size) if r * len(nodes) // world_size == node]
+            i = ranks.index(rank)
+            per_rank = len(nodes[node]) // len(ranks)
+            if per_rank > 0:
+                cores = nodes[node][i * per_rank:(i + 1) * per_rank]
+            else:
+                # More ranks than cores, they have to share
+                cores = [nodes[node][i % len(nodes[node])]]
+            numa_nodes = [node]
+        workers = min(data_workers, len(cores) - 1)
+        plan.append(dict(numa_nodes=numa_nodes, compute=cores[:len(cores) - workers],
+                         workers=cores[len(cores) - workers:]))
+    return plan
+
+
+def _run(rank, world_size, fn, defaults, write_log, no_cuda, args, backend="nccl", plan=None, nnodes=1, node_rank=0,
+         profiling=None):
+    # rank and world_size are local to the node
+    global_rank = node_rank * world_size + rank
+    global_world_size = nnodes * world_size
+    affinity = plan[rank] if plan is not None else None
+    threads = int(os.environ["OMP_NUM_THREADS"])
+    if affinity is not None:
+        threads = len(affinity["compute"])
+        if hasattr(os, 'sched_setaffinity'):
+            # Threads inherit affinity, so it has to be set before torch starts its thread pools
+            os.sched_setaffinity(0, affinity["compute"])
+    # OMP_NUM_THREADS is read only once, when torch is imported, which may have already happened in this process
+    torch.set_num_threads(threads)
+
+    if global_world_size > 1:
+        setup(global_rank, global_world_size, backend)
     if not no_cuda:
         torch.cuda.set_device(rank)
 
-    cfg = defaults
-    cfg.merge_from_file(args.config_file)
-    cfg.merge_from_list(args.opts)
+    cfg = _load_config(defaults, args)
     cfg.freeze()
 
     logger = logging.getLogger("logger")
@@ -60,7 +267,8 @@ def _run(rank, world_size, fn, defaults, write_log, no_cuda, args):
         ch.setFormatter(formatter)
         logger.addHandler(ch)
 
-        if write_log:
+        # Nodes may share OUTPUT_DIR
+        if write_log and global_rank == 0:
             fh = logging.FileHandler(os.path.join(output_dir, 'log.txt'))
             fh.setLevel(logging.DEBUG)
             fh.setFormatter(formatter)
@@ -68,7 +276,17 @@ def _run(rank, world_size, fn, defaults, write_log, no_cuda, args):
 
     logger.info(args)
 
-    logger.info("World size: {}".format(world_size))
+    logger.info("World size: {}".format(global_world_size))
+    if global_world_size > 1:
+        logger.info("Nodes: {}, node rank: {}, processes per node: {}, master: {}:{}".format(
+            nnodes, node_rank, world_size, os.environ['MASTER_ADDR'], os.environ['MASTER_PORT']))
+        logger.info("Backend: {}".format(backend))
+    logger.info("Threads per rank: {}".format(torch.get_num_threads()))
+    if plan is not None:
+        logger.info("Affinity plan:")
+        for r, p in enumerate(plan):
+            logger.info("  rank {}: NUMA nodes {}, compute cores {}, data worker cores {}".format(
+                r, p["numa_nodes"], p["compute"], p["workers"]))
 
     logger.info("Loaded configuration file {}".format(args.config_file))
     with open(args.config_file, "r") as cf:
@@ -81,20 +299,102 @@ def _run(rank, world_size, fn, defaults, write_log, no_cuda, args):
         device = torch.cuda.current_device()
         print("Running on ", torch.cuda.get_device_name(device))
 
-    args.distributed = world_size > 1
-    args_to_pass = dict(cfg=cfg, logger=logger, local_rank=rank, world_size=world_size, distributed=args.distributed)
+    args.distributed = global_world_size > 1
+    mode, start, steps, ranks = profiling if profiling is not None else (None, 0, None, None)
+    if ranks is not None and global_rank not in ranks:
+        mode = None
     signature = inspect.signature(fn)
+    if mode is not None and 'profiler' not in signature.parameters.keys():
+        # Steps are not known, the whole function is profiled
+        start, steps = 0, None
+    profiler = Profiler(mode, output_dir, global_rank, logger, start, steps)
+
+    args_to_pass = dict(cfg=cfg, logger=logger, rank=global_rank, local_rank=rank, world_size=global_world_size,
+                        local_world_size=world_size, node_rank=node_rank, distributed=args.distributed,
+                        affinity=affinity, profiler=profiler)
     matching_args = {}
     for key in args_to_pass.keys():
         if key in signature.parameters.keys():
             matching_args[key] = args_to_pass[key]
-    fn(**matching_args)
+    profiler.begin()
+    try:
+        fn(**matching_args)
+    finally:
+        profiler.end()
 
-    if world_size > 1:
+    if global_world_size > 1:
         cleanup()
 
 
-def run(fn, defaults, description='', default_config='configs/experiment.yaml', world_size=1, write_log=True, no_cuda=False):
+def run(fn, defaults, description='', default_config='configs/experiment.yaml', world_size=1, write_log=True, no_cuda=False,
+        backend=None, pin_cores=False, data_workers=0, nnodes=1, node_rank=0, master_addr=None, master_port=None,
+        profile=None, profile_start=0, profile_steps=None, profile_ranks=(0,)):
+    """ Parses command line, loads config and runs `fn` in `world_size` processes.
+
+    `fn` receives those of arguments `cfg`, `logger`, `rank`, `local_rank`, `world_size`, `local_world_size`,
+    `node_rank`, `distributed`, `affinity`, `profiler` that are in its signature. `rank` and `world_size` are global, over all
+    nodes, `local_rank` and `local_world_size` are within the node. `affinity` is None, unless `pin_cores` is set.
+
+    Options of multi-node runs are taken from the command line (``--nnodes``, ``--node-rank``, ``--master-addr``,
+    ``--master-port``), then from environment variables ``NNODES``, ``NODE_RANK``, ``MASTER_ADDR``, ``MASTER_PORT``,
+    then from the ``DISTRIBUTED`` section of the config (``NNODES``, ``MASTER_ADDR``, ``MASTER_PORT``), if defaults
+    have it, and finally from arguments of this function. Single-node runs pick a free
+    port, if none is given, so that several jobs can run on the same machine.
+
+    Args:
+        fn (Callable): Training function.
+        defaults (yacs.config.CfgNode): Default config, that config file and command line options are merged into.
+        description (str, optional): Description for the command line parser.
+        default_config (str, optional): Config file, if not given in the command line.
+        world_size (int, optional): Number of processes. With CUDA, each process uses the GPU of its rank.
+        write_log (bool, optional): Write log to ``log.txt`` in ``cfg.OUTPUT_DIR``. Defaults to True.
+        no_cuda (bool, optional): Run on CPU. Several processes then train data-parallel with the 'gloo' backend.
+            Defaults to False.
+        backend (str, optional): Backend of `torch.distributed`. Defaults to None, which is 'nccl' with CUDA and 'gloo'
+            without it.
+        pin_cores (bool, optional): Split available cores between processes and pin threads of each process to its
+            own cores, so that they do not migrate between cores and sockets. Where NUMA topology is available in
+            ``/sys``, each process gets cores of one NUMA node. The plan is logged, and `fn` receives its part as
+            `affinity`, a dict with lists of cores `compute` and `workers`, and `numa_nodes`. Defaults to False.
+        data_workers (int, optional): Number of cores of each process left for data-loading workers, e.g. pass
+            ``worker_count=len(affinity['workers']), cores=affinity['workers']`` to :func:`dlutils.batch_provider`.
+            Compute threads use the rest. Defaults to 0.
+        nnodes (int, optional): Number of nodes. Defaults to 1.
+        node_rank (int, optional): Rank of this node. Defaults to 0.
+        master_addr (str, optional): Address of the node with rank 0. Defaults to 'localhost'.
+        master_port (int, optional): Port on the node with rank 0. Defaults to a free port for single-node runs and
+            29500 otherwise.
+        profile (str, optional): Profile `fn` with 'cprofile' or 'torch', see :class:`Profiler`. Defaults to None.
+        profile_start (int, optional): Number of steps to skip before profiling. Defaults to 0.
+        profile_steps (int, optional): Number of steps to profile. Defaults to None, until the end.
+        profile_ranks (list, optional): Global ranks to profile, or None for all. Defaults to (0,).
+
+    Profiling options can also be given in the command line (``--profile``, ``--profile-start``,
+    ``--profile-steps``, ``--profile-ranks``, e.g. ``--profile-ranks 0,1`` or ``all``), or in the ``PROFILE`` section
+    of the config (``MODE``, ``START``, ``STEPS``, ``RANKS``), in that order of precedence. Results are written to
+    ``cfg.OUTPUT_DIR``.
+
+    Example:
+
+        ::
+
+            # On each of two nodes, with 8 GPUs each
+            python train.py --nnodes 2 --node-rank $NODE --master-addr 10.0.0.1 --master-port 29500
+
+            # train.py
+            dlutils.run(train, get_default_cfg(), world_size=8)
+
+            # Profiling steps 100-109 on ranks 0 and 1, without changing the code
+            python train.py --profile torch --profile-start 100 --profile-steps 10 --profile-ranks 0,1
+
+            def train(cfg, logger, profiler):
+                for step in ...:
+                    ...
+                    profiler.step()
+
+    """
+    if backend is None:
+        backend = "gloo" if no_cuda else "nccl"
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument(
         "--config-file",
@@ -103,6 +403,15 @@ def run(fn, defaults, description='', default_config='configs/experiment.yaml',
         help="path to config file",
         type=str,
     )
+    parser.add_argument("--nnodes", default=None, type=int, help="number of nodes")
+    parser.add_argument("--node-rank", default=None, type=int, help="rank of this node")
+    parser.add_argument("--master-addr", default=None, type=str, help="address of the node with rank 0")
+    parser.add_argument("--master-port", default=None, type=int, help="port on the node with rank 0")
+    parser.add_argument("--profile", default=None, choices=['cprofile', 'torch'], help="profile with that profiler")
+    parser.add_argument("--profile-start", default=None, type=int, help="number of steps to skip before profiling")
+    parser.add_argument("--profile-steps", default=None, type=int, help="number of steps to profile")
+    parser.add_argument("--profile-ranks", default=None, type=str,
+                        help="comma separated list of ranks to profile, or 'all'")
     parser.add_argument(
         "opts",
         help="Modify config options using the command-line",
@@ -110,17 +419,48 @@ def run(fn, defaults, description='', default_config='configs/experiment.yaml',
         nargs=argparse.REMAINDER,
     )
 
-    import multiprocessing
-    cpu_count = multiprocessing.cpu_count()
-    os.environ["OMP_NUM_THREADS"] = str(max(1, int(cpu_count / world_size)))
-    del multiprocessing
+    # Cores this process may run on, which can be fewer than the host has, e.g. in containers or SLURM allocations
+    cpu_count = len(_available_cores())
+    threads = str(max(1, int(cpu_count / world_size) - data_workers))
+
+    plan = None
+    if pin_cores:
+        plan = _plan_affinity(world_size, data_workers)
+        threads = str(min(len(p["compute"]) for p in plan))
+    os.environ["OMP_NUM_THREADS"] = threads
+    os.environ["MKL_NUM_THREADS"] = threads
 
     args = parser.parse_args()
 
+    config = _load_config(defaults, args)
+    cfg = config.DISTRIBUTED if 'DISTRIBUTED' in config else None
+    nnodes = int(_option(args.nnodes, 'NNODES', cfg, 'NNODES', nnodes))
+    node_rank = int(_option(args.node_rank, 'NODE_RANK', None, None, node_rank))
+    master_addr = _option(args.master_addr, 'MASTER_ADDR', cfg, 'MASTER_ADDR', master_addr)
+    master_port = _option(args.master_port, 'MASTER_PORT', cfg, 'MASTER_PORT', master_port)
+    if nnodes * world_size > 1:
+        if master_port is None or int(master_port) == 0:
+            master_port = _free_port() if nnodes == 1 else 29500
+        os.environ['MASTER_ADDR'] = str(master_addr or 'localhost')
+        os.environ['MASTER_PORT'] = str(master_port)
+
+    cfg = config.PROFILE if 'PROFILE' in config else None
+    profile = _option(args.profile, None, cfg, 'MODE', profile)
+    profiling = None
+    if profile:
+        profile_start = int(_option(args.profile_start, None, cfg, 'START', profile_start))
+        profile_steps = _option(args.profile_steps, None, cfg, 'STEPS', profile_steps)
+        profile_ranks = _option(args.profile_ranks, None, cfg, 'RANKS', profile_ranks)
+        if isinstance(profile_ranks, str):
+            profile_ranks = None if profile_ranks == 'all' else [int(x) for x in profile_ranks.split(',')]
+        profiling = (profile, profile_start, None if profile_steps is None else int(profile_steps),
+                     None if profile_ranks is None else list(profile_ranks))
+
     if world_size > 1:
         mp.spawn(_run,
-                 args=(world_size, fn, defaults, write_log, no_cuda, args),
+                 args=(world_size, fn, defaults, write_log, no_cuda, args, backend, plan, nnodes, node_rank,
+                       profiling),
                  nprocs=world_size,
                  join=True)
     else:
-        _run(0, world_size, fn, defaults, write_log, no_cuda, args)
+        _run(0, world_size, fn, defaults, write_log, no_cuda, args, backend, plan, nnodes, node_rank, profiling)
@@ -0,0 +1,367 @@
+# Copyright 2019-2020 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import os
+import time
+import struct
+import pickle
+import collections
+import concurrent.futures
+import threading
+import numpy as np
+import torch
+from dlutils.storage import get_codec, fast_hash, temp_suffix, MIN_SAVING
+
+
+__all__ = ['TensorStore', 'is_manifest']
+
+
+_MANIFEST_MAGIC = b'DLCK\x01'
+
+_CHUNKED_MAGIC = b'DLCZ\x01'
+
+# Compressed blobs are stored under a different name, so that raw blobs never have to be told apart by contents
+_CHUNKED_SUFFIX = '.z'
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                          thread_name_prefix='tensor_store')
+        return _pool
+
+
+def is_manifest(path):
+    """ Returns True if file at path is a checkpoint manifest written by :class:`TensorStore` """
+    with open(path, 'rb') as f:
+        return f.read(len(_MANIFEST_MAGIC)) == _MANIFEST_MAGIC
+
+
+def _is_stored(obj):
+    return isinstance(obj, torch.Tensor) and obj.layout == torch.strided and not obj.is_quantized
+
+
+def _raw_bytes(tensor, copy=False):
+    """ Contents of tensor as a flat uint8 numpy array, in C order. With copy, the array never shares memory with
+    tensor.
+    """
+    source = tensor.detach()
+    tensor = source.resolve_conj().resolve_neg().cpu().contiguous().reshape(-1)
+    if copy and tensor.untyped_storage().data_ptr() == source.untyped_storage().data_ptr():
+        tensor = tensor.clone()
+    return tensor.view(torch.uint8).numpy()
+
+
+def _decompress_into(out, codec, chunk):
+    data = codec.decompress(chunk)
+    out[:] = np.frombuffer(data, dtype=np.uint8)
+
+
+class _ManifestPickler(pickle.Pickler):
+    def __init__(self, file, store, copy):
+        super(_ManifestPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.store = store
+        self.copy = copy
+        self.saved = dict()
+        # Blobs that are being compressed: (digest, raw data, futures of compressed chunks)
+        self.compressing = collections.deque()
+        self.compressing_bytes = 0
+        self.bytes_written = 0
+        self.bytes_stored = 0
+        self.bytes_total = 0
+
+    def persistent_id(self, obj):
+        if not _is_stored(obj):
+            return None
+        if id(obj) in self.saved:
+            return self.saved[id(obj)][0]
+        # The same bytes are hashed and written, even if obj is modified in place meanwhile. Otherwise the blob would
+        # not match its digest, and later tensors with that digest would be deduplicated onto wrong contents
+        data = _raw_bytes(obj, self.copy)
+        digest = self.store.digest(data)
+        if not self.store.contains(digest, touch=True):
+            if self.store.compression is None:
+                self.bytes_written += self.store.put(digest, data)
+                self.bytes_stored += data.nbytes
+            else:
+                self.compress(digest, data)
+        self.bytes_total += data.nbytes
+        pid = ('tensor', digest, str(obj.dtype).split('.')[-1], tuple(obj.shape))
+        # Keep obj alive, so that its id is not reused by another object
+        self.saved[id(obj)] = (pid, obj)
+        return pid
+
+    def compress(self, digest, data):
+        # Chunks of all tensors are compressed in parallel, while pickling goes on. Amount of data in flight is
+        # limited, so that compressed chunks of a large checkpoint are not all kept in memory
+        store = self.store
+        futures = [_get_pool().submit(get_codec(store.compression).compress, data[i:i + store.chunk_size],
+                                      store.compression_level) for i in range(0, data.nbytes, store.chunk_size)]
+        self.compressing.append((digest, data, futures))
+        self.compressing_bytes += data.nbytes
+        while self.compressing_bytes > store.chunk_size * 4 * (os.cpu_count() or 1):
+            self.finish_one()
+
+    def finish_one(self):
+        digest, data, futures = self.compressing.popleft()
+        self.compressing_bytes -= data.nbytes
+        chunks = [future.result() for future in futures]
+        self.bytes_written += self.store.put(digest, data, chunks)
+        self.bytes_stored += data.nbytes
+
+    def finish(self):
+        while self.compressing:
+            self.finish_one()
+
+
+class _ManifestUnpickler(pickle.Unpickler):
+    def __init__(self, file, store, mmap):
+        super(_ManifestUnpickler, self).__init__(file)
+        self.store = store
+        self.mmap = mmap
+        self.loaded = dict()
+        self.futures = []
+
+    def persistent_load(self, pid):
+        if pid not in self.loaded:
+            kind, digest, dtype, shape = pid
+            self.loaded[pid] = self.store.get(digest, getattr(torch, dtype), shape, self.mmap, self.futures)
+        return self.loaded[pid]
+
+
+class _ReferenceUnpickler(pickle.Unpickler):
+    """ Collects digests of blobs that manifest references, without loading them """
+    def __init__(self, file):
+        super(_ReferenceUnpickler, self).__init__(file)
+        self.digests = set()
+
+    def persistent_load(self, pid):
+        self.digests.add(pid[1])
+        return None
+
+
+class TensorStore(object):
+    """ Content-addressed storage of tensors.
+
+    Every tensor is stored as a blob named by the hash of its contents, e.g. ``blobs/3f/a2/3fa2...``, so identical
+    tensors are stored only once. A checkpoint is a small manifest, pickled data where tensors are replaced by
+    references to blobs. Tensors that did not change since the previous checkpoint, like frozen weights, are not
+    written again, and all checkpoints share storage.
+
+    With compression, blobs are split into chunks that are compressed in parallel on a shared thread pool, and
+    decompressed in parallel on load. Codecs of the standard library release the GIL, so this scales with the number
+    of cores. Blobs that do not compress well are stored raw, and only raw blobs can be memory-mapped.
+
+    Args:
+        root (str): Directory for blobs.
+        compression (str, optional): Codec, one of 'zlib', 'lzma', 'bz2' or registered with
+            :func:`dlutils.register_codec`. Defaults to None, no compression.
+        compression_level (int, optional): Compression level, passed to the codec.
+        chunk_size (int, optional): Size of chunks in bytes. Defaults to 4 MB.
+    """
+    def __init__(self, root, compression=None, compression_level=None, chunk_size=1 << 22):
+        if compression is not None and get_codec(compression) is None:
+            raise ValueError("Unknown compression: %s" % compression)
+        self.root = root
+        self.compression = compression
+        self.compression_level = compression_level
+        self.chunk_size = chunk_size
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[0:2], digest[2:4], digest)
+
+    def digest(self, data):
+        m = fast_hash()
+        m.update(data)
+        return m.hexdigest()
+
+    def contains(self, digest, touch=False):
+        """ Returns True if blob exists. With touch, updates its modification time, so that :meth:`collect` with grace
+        period does not remove it before a manifest that references it is written.
+        """
+        path = self.blob_path(digest)
+        for path in (path, path + _CHUNKED_SUFFIX):
+            if os.path.exists(path):
+                if touch:
+                    try:
+                        os.utime(path)
+                    except FileNotFoundError:
+                        continue
+                return True
+        return False
+
+    def put(self, digest, data, chunks=None):
+        """ Writes blob of flat uint8 array. If compressed chunks are given, they are written instead, if they save
+        enough space.
+
+        Returns:
+            int: Number of bytes written.
+        """
+        path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if chunks is not None and sum(len(c) for c in chunks) > (1.0 - MIN_SAVING) * data.nbytes:
+            chunks = None
+        if chunks is None:
+            with open(path + temp_suffix(), 'wb') as f:
+                f.write(memoryview(data))
+        else:
+            path += _CHUNKED_SUFFIX
+            name = self.compression.encode('ascii')
+            with open(path + temp_suffix(), 'wb') as f:
+                f.write(b''.join([_CHUNKED_MAGIC, bytes([len(name)]), name,
+                                  struct.pack('<QQ', self.chunk_size, len(chunks)),
+                                  struct.pack('<%dQ' % len(chunks), *[len(c) for c in chunks])]))
+                for c in chunks:
+                    f.write(c)
+        size = os.path.getsize(f.name)
+        os.replace(f.name, path)
+        return size
+
+    def get(self, digest, dtype, shape, mmap=True, futures=None):
+        """ Returns tensor stored in blob.
+
+        Compressed blobs are decompressed on the shared thread pool. If futures is given, futures of the
+        decompression are appended to it and the tensor must not be used before they are done, otherwise this waits.
+        """
+        numel = 1
+        for s in shape:
+            numel *= s
+        nbytes = numel * torch.empty((), dtype=dtype).element_size()
+        if nbytes == 0:
+            return torch.empty(shape, dtype=dtype)
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            if mmap:
+                # Private mapping, pages are read on first access and modifications are not written back
+                data = torch.from_file(path, shared=False, size=nbytes, dtype=torch.uint8)
+            else:
+                with open(path, 'rb') as f:
+                    data = torch.frombuffer(bytearray(f.read()), dtype=torch.uint8)
+            return data.view(dtype).reshape(shape)
+
+        with open(path + _CHUNKED_SUFFIX, 'rb') as f:
+            blob = memoryview(f.read())
+        if bytes(blob[:len(_CHUNKED_MAGIC)]) != _CHUNKED_MAGIC:
+            raise pickle.UnpicklingError("Corrupted blob: %s" % digest)
+        offset = len(_CHUNKED_MAGIC)
+        name = bytes(blob[offset + 1:offset + 1 + blob[offset]]).decode('ascii')
+        codec = get_codec(name)
+        if codec is None:
+            raise pickle.UnpicklingError("Blob is compressed with unknown codec: %s" % name)
+        offset += 1 + blob[offset]
+        chunk_size, count = struct.unpack_from('<QQ', blob, offset)
+        offset += 16
+        sizes = struct.unpack_from('<%dQ' % count, blob, offset)
+        offset += 8 * count
+
+        data = torch.empty(nbytes, dtype=torch.uint8)
+        out = data.numpy()
+        pending = []
+        for i, size in enumerate(sizes):
+            pending.append(_get_pool().submit(_decompress_into, out[i * chunk_size:(i + 1) * chunk_size],
+                                              codec, blob[offset:offset + size]))
+            offset += size
+        if futures is not None:
+            futures += pending
+        else:
+            for future in pending:
+                future.result()
+        return data.view(dtype).reshape(shape)
+
+    def save(self, data, path, copy=True):
+        """ Stores tensors of data and writes manifest to path.
+
+        Args:
+            data: Data to save, arbitrary picklable object with tensors.
+            path (str): Path of the manifest.
+            copy (bool, optional): Hash and write a private copy of every tensor, so that tensors modified in place
+                while saving can't corrupt the store. Can be disabled only if nothing modifies the tensors until this
+                returns. Defaults to True.
+
+        Returns:
+            tuple: Number of bytes written including the manifest, size of tensors that were stored, and total size of
+            tensors in the checkpoint.
+        """
+        with open(path + temp_suffix(), 'wb') as f:
+            f.write(_MANIFEST_MAGIC)
+            pickler = _ManifestPickler(f, self, copy)
+            try:
+                pickler.dump(data)
+            finally:
+                pickler.finish()
+            manifest_size = f.tell()
+        # Manifest is renamed last, so it never references missing blobs
+        os.replace(f.name, path)
+        return pickler.bytes_written + manifest_size, pickler.bytes_stored, pickler.bytes_total
+
+    def load(self, path, mmap=True):
+        with open(path, 'rb') as f:
+            if f.read(len(_MANIFEST_MAGIC)) != _MANIFEST_MAGIC:
+                raise ValueError("Not a checkpoint manifest: %s" % path)
+            unpickler = _ManifestUnpickler(f, self, mmap)
+            data = unpickler.load()
+        for future in unpickler.futures:
+            future.result()
+        return data
+
+    def referenced(self, path):
+        """ Returns set of digests of blobs that manifest at path references """
+        with open(path, 'rb') as f:
+            if f.read(len(_MANIFEST_MAGIC)) != _MANIFEST_MAGIC:
+                raise ValueError("Not a checkpoint manifest: %s" % path)
+            unpickler = _ReferenceUnpickler(f)
+            unpickler.load()
+            return unpickler.digests
+
+    def collect(self, manifests, grace=0):
+        """ Removes blobs that none of the manifests reference.
+
+        Args:
+            manifests (list): Paths of manifests.
+            grace (float, optional): Blobs that were written or reused less than that many seconds ago are kept, since
+                other processes could be writing manifests that reference them. Defaults to 0.
+
+        Returns:
+            int: Number of bytes freed.
+        """
+        keep = set()
+        for path in manifests:
+            try:
+                keep |= self.referenced(path)
+            except FileNotFoundError:
+                pass
+        freed = 0
+        deadline = time.time() - grace
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                # Temporary files belong to writes in progress
+                if name.split('.')[0] in keep or '.tmp.' in name:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime > deadline:
+                        continue
+                    size = stat.st_size
+                    os.remove(path)
+                    freed += size
+                except FileNotFoundError:
+                    pass
+        return freed
@@ -18,7 +18,6 @@ import mmap
 import os
 import numpy as np
 from contextlib import closing
-from scipy import misc
 
 
 class Mnist:
@@ -62,6 +61,7 @@ class Mnist:
                                     :16 + i * self._record_bytes + self._record_bytes], dtype=np.uint8)
                             img = np.reshape(img, (28, 28))
                             if self._resize_to_32x32:
+                                from scipy import misc
                                 img = misc.imresize(img, (32, 32), interp='bilinear')
                             self.items.append((label, img))
 
@@ -0,0 +1,105 @@
+# Copyright 2018-2020 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Primitives shared by on-disk stores, :class:`dlutils.cache` and :class:`dlutils.pytorch.tensor_store.TensorStore`:
+registry of compression codecs, fast content hash and names of temporary files.
+"""
+
+import os
+import zlib
+import lzma
+import bz2
+import hashlib
+import threading
+try:
+    import xxhash
+    has_xxhash = True
+except ImportError:
+    has_xxhash = False
+
+
+__all__ = ['register_codec', 'get_codec', 'fast_hash', 'temp_suffix', 'MIN_SAVING']
+
+
+# Compression is not used if it does not save at least that fraction of size
+MIN_SAVING = 0.1
+
+
+class _Codec(object):
+    def __init__(self, compress, decompress, errors):
+        self.compress = compress
+        self.decompress = decompress
+        self.errors = errors
+
+
+_codecs = dict(
+    zlib=_Codec(lambda data, level: zlib.compress(data, 6 if level is None else level), zlib.decompress,
+                (zlib.error,)),
+    lzma=_Codec(lambda data, level: lzma.compress(data, preset=level), lzma.decompress, (lzma.LZMAError,)),
+    bz2=_Codec(lambda data, level: bz2.compress(data, 9 if level is None else level), bz2.decompress,
+               (OSError, ValueError)),
+)
+
+
+def register_codec(name, compress, decompress, errors=(Exception,)):
+    """ Registers a compression codec, that can be used as :attr:`compression` argument of :class:`dlutils.cache` and
+    :class:`dlutils.pytorch.Checkpointer`.
+
+    Name of the codec is stored in the header of each compressed entry, so the codec must be registered under the same
+    name before such entries can be read.
+
+    Args:
+        name (str): Name of the codec.
+        compress (Callable[[bytes, Optional[int]], bytes]): Compression function. Receives data and compression level,
+            which is None if not specified.
+        decompress (Callable[[bytes], bytes]): Decompression function.
+        errors (tuple, optional): Exceptions raised by :attr:`decompress` on corrupted data. Such entries are
+            recomputed. Defaults to (Exception,).
+
+    Example:
+
+        ::
+
+            import zstandard
+            dlutils.cache.register_codec('zstd',
+                                         lambda data, level: zstandard.compress(data, level or 3),
+                                         zstandard.decompress)
+
+            @dlutils.cache(compression='zstd')
+            def expensive_function(x):
+                ...
+
+    """
+    if len(name.encode('ascii')) > 255:
+        raise ValueError("Codec name is too long")
+    _codecs[name] = _Codec(compress, decompress, tuple(errors))
+
+
+def get_codec(name):
+    """ Returns codec registered under name, or None. Codec has ``compress(data, level)`` and ``decompress(data)``
+    methods, and ``errors``, tuple of exceptions that ``decompress`` raises on corrupted data.
+    """
+    return _codecs.get(name)
+
+
+def fast_hash():
+    """ Returns a new 128-bit hash object, xxhash if installed, otherwise blake2b. """
+    if has_xxhash:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=16)
+
+
+def temp_suffix():
+    """ Suffix of a temporary file, unique for the calling process and thread. """
+    return '.tmp.%d.%d' % (os.getpid(), threading.get_ident())